@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Closed-loop longitudinal simulation of the patched planner.
+
+Each scenario drives a fresh Planner with a kinematic lead (cruise, follow, cut-in,
+stop and go, hard braking), integrates ego motion from the published aTarget through
+a first order actuator lag and runs on a simulated clock with the stand-in libmpc
+or the NumPy reference solver, so results only depend on the scenario seed. Scenarios are spread across processes.
+Reports planner CPU per simulated second, MPC resets, new leads and the distance jumps
+the lead tracker kept as the same lead, FCW triggers,
+TR statistics and the closest gap, per scenario kind.
+
+  python -m devtools.closed_loop_sim --openpilot ~/openpilot --scenarios 2000 --json sim.json
+  python -m devtools.closed_loop_sim --baseline sim.json  # exits 1 on regression
+"""
+import argparse
+from collections import namedtuple
+import json
+from multiprocessing import Pool
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from devtools import openpilot_env
+from devtools.fake_messaging import FakePubMaster, FakeSubMaster, fake_CP, lead
+
+DT = 0.05  # s, radarState rate
+ACTUATOR_TAU = 0.25  # s, ego accel lag behind aTarget
+KINDS = ['cruise', 'follow', 'cut_in', 'stop_and_go', 'hard_brake']
+
+Scenario = namedtuple('Scenario', ['index', 'kind', 'seed', 'duration'])
+
+
+class SimClock:
+    """Replaces sec_since_boot in the planner modules"""
+    def __init__(self):
+        self.t = 0.
+
+    def __call__(self):
+        return self.t
+
+
+_clock = SimClock()
+_lp = None
+
+
+def lead_profile(kind, rng, n_ticks, v_ego):
+    """
+    Returns: (present, a_lead per tick, gap and lead speed when the lead appears)
+    """
+    t = np.arange(n_ticks) * DT
+    present = np.ones(n_ticks, dtype=bool)
+    a_lead = np.zeros(n_ticks)
+    gap = rng.uniform(20., 50.)
+    v_lead = v_ego + rng.uniform(-2., 2.)
+
+    if kind == 'cruise':
+        present[:] = False
+    elif kind == 'follow':
+        # Smooth random accel, an Ornstein-Uhlenbeck process
+        noise = rng.normal(0., 0.25, n_ticks)
+        for i in range(1, n_ticks):
+            a_lead[i] = a_lead[i - 1] * (1. - DT / 3.) + noise[i] * np.sqrt(DT)
+    elif kind == 'cut_in':
+        t_cut = rng.uniform(5., 15.)
+        present[t < t_cut] = False
+        gap = rng.uniform(6., 20.)
+        v_lead = v_ego - rng.uniform(0., 5.)
+    elif kind == 'stop_and_go':
+        period = rng.uniform(15., 30.)
+        v_mean = rng.uniform(3., 8.)
+        v_lead = v_mean
+        a_lead = v_mean * 2 * np.pi / period * np.cos(2 * np.pi * t / period)
+    elif kind == 'hard_brake':
+        t_brake = rng.uniform(5., 15.)
+        a_lead[t >= t_brake] = -rng.uniform(2., 5.)  # up to past the planner's -3.5 m/s^2 limit
+    else:
+        raise ValueError(f'unknown scenario kind {kind}')
+    return present, a_lead, gap, max(v_lead, 0.)
+
+
+def make_scenarios(n, seed=0, duration=40.):
+    rng = np.random.default_rng(seed)
+    return [Scenario(i, KINDS[i % len(KINDS)], int(rng.integers(2**31)), duration) for i in range(n)]
+
+
+def simulate(scenario):
+    from devtools.planner_bench import StubbedIO
+    from selfdrive.controls.lib.longcontrol import LongCtrlState
+
+    rng = np.random.default_rng(scenario.seed)
+    n_ticks = int(scenario.duration / DT)
+    v_ego = rng.uniform(5., 30.) if scenario.kind != 'stop_and_go' else rng.uniform(2., 8.)
+    v_cruise = v_ego + rng.uniform(0., 5.)
+    present, a_lead_cmd, lead_gap, v_lead = lead_profile(scenario.kind, rng, n_ticks, v_ego)
+
+    x_ego, a_ego = 0., 0.
+    x_lead = lead_gap
+
+    _clock.t = 0.
+    io = StubbedIO(_lp)
+    CP = fake_CP()
+    planner = _lp.Planner(CP)
+    sm = FakeSubMaster()
+    pm = FakePubMaster()
+
+    controls_state = SimpleNamespace(longControlState=LongCtrlState.pid, vCruise=v_cruise * 3.6, forceDecel=False, active=True)
+    cpu = 0.
+    fcw_triggers = 0
+    prev_fcw = False
+    TRs = []
+    min_gap = np.inf
+    ticks = 0
+    try:
+        for i in range(n_ticks):
+            _clock.t = i * DT
+            # Lead kinematics, placed at its gap when it cuts in
+            if present[i] and i > 0 and not present[i - 1]:
+                x_lead = x_ego + lead_gap
+            a_lead = a_lead_cmd[i] if v_lead > 0. or a_lead_cmd[i] > 0. else 0.
+            v_lead = max(v_lead + a_lead * DT, 0.)
+            x_lead += v_lead * DT
+            gap = x_lead - x_ego
+            if present[i]:
+                min_gap = min(min_gap, gap)
+                if gap <= 0.:
+                    break  # Collision, nothing after it is meaningful
+            ticks += 1
+
+            car_state = SimpleNamespace(vEgo=v_ego, aEgo=a_ego, steeringAngleDeg=0., leftBlinker=False, rightBlinker=False,
+                                        gasPressed=False, brakePressed=False, cruiseState=SimpleNamespace(enabled=True))
+            radar_state = SimpleNamespace(leadOne=lead(bool(present[i]), gap, v_lead, a_lead, fcw=bool(present[i])),
+                                          leadTwo=lead())
+            sm.update_msgs(_clock.t, {'carState': car_state, 'controlsState': controls_state, 'radarState': radar_state})
+
+            start = time.process_time()
+            planner.update(sm, CP)
+            planner.publish(sm, pm)
+            cpu += time.process_time() - start
+
+            fcw_triggers += planner.fcw and not prev_fcw
+            prev_fcw = planner.fcw
+            if present[i]:
+                TRs.append(planner.mpc1.dynamic_follow.TR)
+
+            # Ego follows the plan through the actuator lag
+            a_target = pm.last['longitudinalPlan'].longitudinalPlan.aTarget
+            a_ego += (a_target - a_ego) * DT / ACTUATOR_TAU
+            v_ego = max(v_ego + a_ego * DT, 0.)
+            x_ego += v_ego * DT
+    finally:
+        io.close(planner)
+
+    TRs = np.array(TRs)
+    return {
+        'index': scenario.index,
+        'kind': scenario.kind,
+        'seed': scenario.seed,
+        'sim_seconds': ticks * DT,
+        'cpu_per_sim_second': cpu / max(ticks * DT, DT),
+        'resets': sum(mpc.warm_resets + mpc.cold_resets for mpc in (planner.mpc1, planner.mpc2)),
+        'new_leads': planner.mpc1.new_leads,
+        'spurious_new_leads': planner.mpc1.spurious_new_leads,
+        'fcw_triggers': int(fcw_triggers),
+        'TR_mean': float(TRs.mean()) if len(TRs) else None,
+        'TR_p5': float(np.percentile(TRs, 5)) if len(TRs) else None,
+        'TR_p95': float(np.percentile(TRs, 95)) if len(TRs) else None,
+        'min_gap': float(min_gap) if np.isfinite(min_gap) else None,
+    }
+
+
+def _init_worker(openpilot_path, backend):
+    global _lp
+    openpilot_env.setup(openpilot_path)
+    openpilot_env.use_mpc_backend(backend)
+    from selfdrive.controls.lib import dynamic_follow, long_mpc, longitudinal_planner
+    for module in (dynamic_follow, long_mpc, longitudinal_planner):
+        module.sec_since_boot = _clock
+    _lp = longitudinal_planner
+
+
+def run(scenarios, processes=None, openpilot_path=None, backend='fake'):
+    with Pool(processes, initializer=_init_worker, initargs=(openpilot_path, backend)) as pool:
+        results = pool.map(simulate, scenarios, chunksize=max(len(scenarios) // (4 * (processes or 8)), 1))
+    return sorted(results, key=lambda r: r['index'])
+
+
+def summarize(results):
+    summary = {}
+    for kind in KINDS + ['all']:
+        rs = [r for r in results if kind in ('all', r['kind'])]
+        if not rs:
+            continue
+        cpu = np.array([r['cpu_per_sim_second'] for r in rs])
+        TR = np.array([r['TR_mean'] for r in rs if r['TR_mean'] is not None])
+        gaps = [r['min_gap'] for r in rs if r['min_gap'] is not None]
+        summary[kind] = {
+            'scenarios': len(rs),
+            'cpu_ms_per_sim_second_mean': float(cpu.mean() * 1e3),
+            'cpu_ms_per_sim_second_max': float(cpu.max() * 1e3),
+            'resets': sum(r['resets'] for r in rs),
+            'new_leads': sum(r['new_leads'] for r in rs),
+            'spurious_new_leads': sum(r['spurious_new_leads'] for r in rs),
+            'fcw_triggers': sum(r['fcw_triggers'] for r in rs),
+            'TR_mean': float(TR.mean()) if len(TR) else None,
+            'min_gap': min(gaps) if gaps else None,
+            'collisions': sum(g <= 0. for g in gaps),
+        }
+    return summary
+
+
+def regressions(summary, baseline, tolerance):
+    found = []
+    for kind, s in summary.items():
+        old = baseline.get(kind)
+        if old is None:
+            continue
+        if s['cpu_ms_per_sim_second_mean'] > old['cpu_ms_per_sim_second_mean'] * tolerance:
+            found.append(f"{kind}: cpu {old['cpu_ms_per_sim_second_mean']:.1f} -> {s['cpu_ms_per_sim_second_mean']:.1f} ms/s")
+        for name in ('resets', 'fcw_triggers'):
+            if s[name] > max(old[name] * tolerance, old[name] + 1):
+                found.append(f'{kind}: {name} {old[name]} -> {s[name]}')
+        if s['collisions'] > old['collisions']:
+            found.append(f"{kind}: collisions {old['collisions']} -> {s['collisions']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--openpilot', help='openpilot checkout, defaults to $OPENPILOT_PATH')
+    parser.add_argument('--scenarios', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=40., help='simulated seconds per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, help='defaults to all cores')
+    parser.add_argument('--backend', choices=openpilot_env.MPC_BACKENDS, default='fake', help='mpc solver')
+    parser.add_argument('--json', help='write the summary and per scenario results here')
+    parser.add_argument('--baseline', help='results from a previous --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='allowed ratio over baseline for cpu, resets and FCW')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    results = run(make_scenarios(args.scenarios, args.seed, args.duration), args.processes, args.openpilot, args.backend)
+    summary = summarize(results)
+    sim_seconds = sum(r['sim_seconds'] for r in results)
+    print(f'{len(results)} scenarios, {sim_seconds:.0f} simulated s in {time.monotonic() - start:.1f} s')
+    print(f"{'kind':<14}{'n':>6}{'cpu ms/s':>10}{'max':>8}{'resets':>8}{'leads':>7}{'spur':>6}{'fcw':>6}{'TR':>7}{'min gap':>9}{'crash':>7}")
+    for kind, s in summary.items():
+        TR = f"{s['TR_mean']:.2f}" if s['TR_mean'] is not None else '-'
+        min_gap = f"{s['min_gap']:.1f}" if s['min_gap'] is not None else '-'
+        print(f"{kind:<14}{s['scenarios']:>6}{s['cpu_ms_per_sim_second_mean']:>10.1f}{s['cpu_ms_per_sim_second_max']:>8.1f}"
+              f"{s['resets']:>8}{s['new_leads']:>7}{s['spurious_new_leads']:>6}{s['fcw_triggers']:>6}{TR:>7}{min_gap:>9}{s['collisions']:>7}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'summary': summary, 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['summary']
+        found = regressions(summary, baseline, args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}')
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Checks dynamic_follow.batch.evaluate_drive against DynamicFollow run tick by tick.
+
+Synthetic drives go through stop and go, with speed ramps across sng_speed, lead
+drop-outs and new leads. Timestamps are 20 Hz, jittered on every other drive, with the
+odd stall.
+Drives given as .npz files or drive_columns stores, like df_sweep's, are checked too.
+Every tick's TR, sng flag, distance mod factors and oldest v_ego in the history must be
+equal, not just close.
+
+  python -m devtools.df_batch_check --drives 40  # exits 1 on a mismatch
+  python -m devtools.df_batch_check store/ drives/*.npz
+"""
+import argparse
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+from devtools import openpilot_env
+from devtools.df_sweep import load_drives
+
+NO_COSTS = SimpleNamespace(change_costs=lambda *args: None)
+
+
+def synthetic_drive(seed, n):
+    """(t, v_ego, a_ego, v_lead, a_lead, lead_status) like df_sweep.load_drives"""
+    from selfdrive.controls.lib.dynamic_follow.batch import lead_inputs
+
+    rng = np.random.default_rng(seed)
+    # Every other drive on an exact 20 Hz clock, the v_ego history window then ends right at a sample
+    dt = 0.05 + (rng.normal(0., 0.002, n) if seed % 2 else np.zeros(n))
+    stalls = rng.random(n) < 0.005
+    dt[stalls] += rng.uniform(0.1, 1., stalls.sum())
+    t = 100. + np.cumsum(np.abs(dt))
+
+    # Speed targets from standstill to highway held for a few seconds, approached at a bounded accel
+    targets = np.repeat(rng.choice([0., 0., 3., 6., 8., 12., 20., 30.], n // 60 + 1), 60)[:n]
+    v_ego = np.zeros(n)
+    a_ego = np.zeros(n)
+    for i in range(1, n):
+        a_ego[i] = np.clip(targets[i] - v_ego[i - 1], -3., 2.) + rng.normal(0., 0.1)
+        v_ego[i] = max(v_ego[i - 1] + a_ego[i] * (t[i] - t[i - 1]), 0.)
+
+    v_lead = v_ego + np.repeat(rng.normal(0., 2., n // 40 + 1), 40)[:n] + rng.normal(0., 0.3, n)
+    a_lead = np.repeat(rng.uniform(-3., 1.5, n // 40 + 1), 40)[:n] + rng.normal(0., 0.1, n)
+    lead_status = np.repeat(rng.random(n // 20 + 1) < 0.8, 20)[:n]
+    lead_status[rng.random(n) < 0.01] = False  # single tick drop-outs
+    v_lead, a_lead = lead_inputs(v_lead, a_lead)
+    return t, v_ego, a_ego, v_lead, a_lead, lead_status
+
+
+def run_ticks(t, v_ego, a_ego, v_lead, a_lead, lead_status):
+    """DynamicFollow.update tick by tick as LongitudinalMpc calls it, on the drive's clock"""
+    from selfdrive.controls.lib import dynamic_follow
+
+    clock = SimpleNamespace(t=0.)
+    sec_since_boot = dynamic_follow.sec_since_boot
+    dynamic_follow.sec_since_boot = lambda: clock.t
+    try:
+        df = dynamic_follow.DynamicFollow(1)
+        n = len(t)
+        TR = np.zeros(n)
+        sng = np.zeros(n, dtype=bool)
+        v_rel_factor = np.full(n, np.nan)
+        a_rel_factor = np.full(n, np.nan)
+        oldest_v_ego = np.full(n, np.nan)
+        prev_status = False
+        columns = (x.tolist() for x in (t, v_ego, a_ego, v_lead, a_lead, lead_status))
+        for i, (t_i, v, a, v_l, a_l, status) in enumerate(zip(*columns)):
+            clock.t = t_i
+            CS = SimpleNamespace(vEgo=v, aEgo=a, leftBlinker=False, rightBlinker=False, cruiseState=SimpleNamespace(enabled=True))
+            if status:
+                df.update_lead(v_l, a_l, 30., True, not prev_status)
+            else:
+                df.update_lead(status=False)
+            prev_status = status
+            TR[i] = df.update(CS, NO_COSTS)
+            sng[i] = df.sng
+            if status:
+                v_rel_factor[i] = df.dmc_v_rel._mods(df.dmc_v_rel.i)
+                a_rel_factor[i] = df.dmc_a_rel._mods(df.dmc_a_rel.i)
+                oldest_v_ego[i] = df.df_data.v_egos.oldest('v_ego')
+    finally:
+        dynamic_follow.sec_since_boot = sec_since_boot
+    return TR, sng, v_rel_factor, a_rel_factor, oldest_v_ego
+
+
+def check_drive(drive):
+    """Returns: (lead ticks, sng ticks, list of mismatch descriptions)"""
+    from selfdrive.controls.lib.dynamic_follow.batch import evaluate_drive
+
+    TR, sng, v_rel_factor, a_rel_factor, oldest_v_ego = run_ticks(*drive)
+    result = evaluate_drive(*drive)
+    mismatches = []
+    for name, ticks, batch in (('TR', TR, result.TR), ('sng', sng, result.sng),
+                               ('v_rel_factor', v_rel_factor, result.v_rel_factor),
+                               ('a_rel_factor', a_rel_factor, result.a_rel_factor),
+                               ('oldest_v_ego', oldest_v_ego, result.oldest_v_ego)):
+        # NaN on ticks without a lead in both
+        differ = np.flatnonzero(~((ticks == batch) | (np.isnan(ticks) & np.isnan(batch))))
+        if len(differ):
+            i = differ[0]
+            mismatches.append(f'{name} differs on {len(differ)} ticks, first {i}: {ticks[i]!r} tick by tick, {batch[i]!r} batch')
+    return int(drive[5].sum()), int(sng.sum()), mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', help='.npz drives or drive_columns stores, checked after the synthetic ones')
+    parser.add_argument('--openpilot', help='openpilot checkout, defaults to $OPENPILOT_PATH')
+    parser.add_argument('--drives', type=int, default=40, help='synthetic drives')
+    parser.add_argument('--ticks', type=int, default=6000, help='per synthetic drive, 20 Hz')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    openpilot_env.setup(args.openpilot)
+    drives = [(f'seed {seed}', synthetic_drive(seed, args.ticks)) for seed in range(args.seed, args.seed + args.drives)]
+    for path in args.paths:
+        drives += [(f'{path} drive {i}', drive) for i, drive in enumerate(load_drives(path))]
+
+    ticks, lead_ticks, sng_ticks, failed = 0, 0, 0, 0
+    for name, drive in drives:
+        drive_lead_ticks, drive_sng_ticks, mismatches = check_drive(drive)
+        ticks += len(drive[0])
+        lead_ticks += drive_lead_ticks
+        sng_ticks += drive_sng_ticks
+        for mismatch in mismatches:
+            print(f'{name}: {mismatch}')
+        failed += bool(mismatches)
+
+    print(f'{len(drives)} drives, {ticks} ticks, {lead_ticks} with a lead, {sng_ticks} in sng, {failed} mismatching drives')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Parameter sweep for DynamicFollow over recorded drives, spread across cores.
+
+Each drive is an .npz with per tick arrays t, v_ego, a_ego, v_lead, a_lead
+(radar values, filtered like LongitudinalMpc does) and lead_status, or a directory
+with a devtools.drive_columns store contributing each of its drives. The grid is
+a JSON object mapping parameter names to lists of values, nested DistanceModController
+gains use dots, e.g. {"sng_TR": [1.6, 1.8], "dmc_v_rel.k_i": [0.03, 0.042]}.
+See dynamic_follow.batch.default_params for the names.
+
+  python -m devtools.df_sweep --grid grid.json --json sweep.json drives/*.npz
+  python -m devtools.df_sweep --grid grid.json store/
+"""
+import argparse
+import copy
+import itertools
+import json
+from multiprocessing import Pool
+import os
+import time
+
+import numpy as np
+
+from devtools import openpilot_env
+from devtools.drive_columns import DriveColumns
+
+_drives = None
+
+
+def expand_grid(grid):
+    names = list(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def apply_overrides(params, overrides):
+    params = copy.deepcopy(params)
+    for name, value in overrides.items():
+        target = params
+        *parents, leaf = name.split('.')
+        for parent in parents:
+            target = target[parent]
+        assert leaf in target, f'unknown parameter {name}'
+        target[leaf] = value
+    return params
+
+
+def load_drives(path):
+    from selfdrive.controls.lib.dynamic_follow.batch import lead_inputs
+    if os.path.isdir(path):
+        store = DriveColumns(path)
+        drives = []
+        for i in range(len(store.drives)):
+            d = store.drive(i)
+            v_lead, a_lead = lead_inputs(d['radarState.leadOne.vLead'].astype(np.float64), d['radarState.leadOne.aLeadK'].astype(np.float64))
+            drives.append((d['t'] / 1e9, d['carState.vEgo'], d['carState.aEgo'], v_lead, a_lead, d['radarState.leadOne.status']))
+        return drives
+    with np.load(path) as drive:
+        v_lead, a_lead = lead_inputs(drive['v_lead'], drive['a_lead'])
+        return [(drive['t'], drive['v_ego'], drive['a_ego'], v_lead, a_lead, drive['lead_status'].astype(bool))]
+
+
+def _init_worker(openpilot_path, paths):
+    global _drives
+    openpilot_env.setup(openpilot_path)
+    _drives = [drive for p in paths for drive in load_drives(p)]
+
+
+def _evaluate(overrides):
+    from selfdrive.controls.lib.dynamic_follow.batch import default_params, evaluate_drive
+    params = apply_overrides(default_params(), overrides)
+
+    TRs, sngs, dTRs = [], [], []
+    for drive in _drives:
+        result = evaluate_drive(*drive, params=params)
+        lead = drive[5]
+        TRs.append(result.TR[lead])
+        sngs.append(result.sng[lead])
+        dTRs.append(np.abs(np.diff(result.TR)))
+    TR = np.concatenate(TRs)
+    dTR = np.concatenate(dTRs)
+    return {
+        'params': overrides,
+        'lead_ticks': int(len(TR)),
+        'TR_mean': float(TR.mean()) if len(TR) else None,
+        'TR_p5': float(np.percentile(TR, 5)) if len(TR) else None,
+        'TR_p95': float(np.percentile(TR, 95)) if len(TR) else None,
+        'sng_fraction': float(np.concatenate(sngs).mean()) if len(TR) else None,
+        'mean_abs_dTR': float(dTR.mean()) if len(dTR) else None,
+    }
+
+
+def sweep(paths, grid, processes=None, openpilot_path=None):
+    param_sets = list(expand_grid(grid))
+    with Pool(processes, initializer=_init_worker, initargs=(openpilot_path, paths)) as pool:
+        return pool.map(_evaluate, param_sets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('drives', nargs='+', help='.npz drives or drive_columns stores')
+    parser.add_argument('--grid', required=True, help='JSON parameter grid')
+    parser.add_argument('--openpilot', help='openpilot checkout, defaults to $OPENPILOT_PATH')
+    parser.add_argument('--processes', type=int, help='defaults to all cores')
+    parser.add_argument('--json', help='write results here')
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    start = time.monotonic()
+    results = sweep(args.drives, grid, args.processes, args.openpilot)
+    print(f'{len(results)} parameter sets over {len(args.drives)} drives in {time.monotonic() - start:.1f} s')
+    for r in results:
+        print(f"{json.dumps(r['params'])}: TR mean {r['TR_mean']} p5 {r['TR_p5']} p95 {r['TR_p95']} "
+              f"sng {r['sng_fraction']} |dTR| {r['mean_abs_dTR']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Columnar store of the planner inputs from recorded drives, for offline evaluation of
+Planner, LongitudinalMpc and DynamicFollow without decoding rlogs again.
+
+A store is a directory with one raw little-endian file per field in COLUMNS, a row per
+radarState with the latest carState/controlsState before it like rlog_drive, and
+index.json with the row count and the [start, stop) rows of each drive. Columns are
+memory-mapped read only, so reading a month of drives is bound by the page cache. Values are
+the float32 cereal sends, so nothing is lost.
+Converting appends drives, rows past the index's count are left from an interrupted
+convert and overwritten.
+
+  python -m devtools.drive_columns store/ rlogs/route1/ rlogs/route2/ rlog.bz2  # a directory is one drive
+  python -m devtools.drive_columns store/ --info
+"""
+import argparse
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+LONG_CONTROL_STATES = ('off', 'pid', 'stopping', 'starting')
+LEAD_FIELDS = [
+    ('status', np.bool_), ('dRel', np.float32), ('yRel', np.float32), ('vLead', np.float32), ('vLeadK', np.float32),
+    ('aLeadK', np.float32), ('aLeadTau', np.float32), ('vLat', np.float32), ('fcw', np.bool_),
+]
+# column: (service, field path, dtype)
+COLUMNS = {
+    't': ('radarState', 'logMonoTime', np.int64),
+    'carState.vEgo': ('carState', 'vEgo', np.float32),
+    'carState.aEgo': ('carState', 'aEgo', np.float32),
+    'carState.steeringAngleDeg': ('carState', 'steeringAngleDeg', np.float32),
+    'carState.leftBlinker': ('carState', 'leftBlinker', np.bool_),
+    'carState.rightBlinker': ('carState', 'rightBlinker', np.bool_),
+    'carState.gasPressed': ('carState', 'gasPressed', np.bool_),
+    'carState.brakePressed': ('carState', 'brakePressed', np.bool_),
+    'carState.cruiseState.enabled': ('carState', 'cruiseState.enabled', np.bool_),
+    'controlsState.longControlState': ('controlsState', 'longControlState', np.uint8),  # index into LONG_CONTROL_STATES
+    'controlsState.vCruise': ('controlsState', 'vCruise', np.float32),
+    'controlsState.forceDecel': ('controlsState', 'forceDecel', np.bool_),
+    'controlsState.active': ('controlsState', 'active', np.bool_),
+}
+for _lead in ('leadOne', 'leadTwo'):
+    for _name, _dtype in LEAD_FIELDS:
+        COLUMNS[f'radarState.{_lead}.{_name}'] = ('radarState', f'{_lead}.{_name}', _dtype)
+
+
+def _get(msg, path):
+    for name in path.split('.'):
+        msg = getattr(msg, name)
+    return msg
+
+
+def rlog_rows(paths):
+    """Yields a tuple of COLUMNS values per radarState of the rlogs. Needs openpilot's tools.lib.logreader"""
+    from tools.lib.logreader import LogReader
+
+    getters = [(service, path) for service, path, _ in COLUMNS.values()]
+    latest = {}
+    for path in paths:
+        for msg in LogReader(path):
+            which = msg.which()
+            if which in ('carState', 'controlsState'):
+                latest[which] = getattr(msg, which)
+            elif which == 'radarState' and len(latest) == 2:
+                latest['radarState'] = msg.radarState
+                row = []
+                for service, field in getters:
+                    if field == 'logMonoTime':
+                        row.append(msg.logMonoTime)
+                    elif field == 'longControlState':
+                        row.append(LONG_CONTROL_STATES.index(str(latest[service].longControlState)))
+                    else:
+                        row.append(_get(latest[service], field))
+                yield tuple(row)
+                del latest['radarState']
+
+
+def _drive_paths(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path)) if 'rlog' in f]
+    return [path]
+
+
+class DriveColumns:
+    """A store, opened read only"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        if self.index.get('index_version') != INDEX_VERSION:
+            raise Exception(f'Unsupported drive store version {self.index.get("index_version")}')
+        self.n_rows = self.index['rows']
+        self.drives = [tuple(d['rows']) for d in self.index['drives']]
+        self.columns = {}
+        for name, dtype in self.index['columns'].items():
+            file = os.path.join(path, f'{name}.bin')
+            # np.memmap can't map 0 bytes
+            self.columns[name] = np.memmap(file, dtype, 'r', shape=(self.n_rows,)) if self.n_rows else np.zeros(0, dtype)
+
+    def drive(self, i):
+        """Zero-copy columns of drive i"""
+        start, stop = self.drives[i]
+        return {name: column[start:stop] for name, column in self.columns.items()}
+
+    def batches(self, batch_size=4096, names=None, drives=None):
+        """Yields (drive, {column: rows}) slices of at most batch_size rows, never spanning drives"""
+        names = names or list(COLUMNS)
+        for i in (range(len(self.drives)) if drives is None else drives):
+            start, stop = self.drives[i]
+            for s in range(start, stop, batch_size):
+                yield i, {name: self.columns[name][s:min(s + batch_size, stop)] for name in names}
+
+    def messages(self, drives=None, batch_size=4096):
+        """
+        Yields (t, {service: msg}) like rlog_drive, for FakeSubMaster.update_msgs.
+        Needs openpilot on the path for LongCtrlState
+        """
+        from selfdrive.controls.lib.longcontrol import LongCtrlState
+        long_control_states = [getattr(LongCtrlState, name) for name in LONG_CONTROL_STATES]
+
+        for _, batch in self.batches(batch_size, drives=drives):
+            # Python scalars a column at a time, per element NumPy access is much slower
+            c = {name: column.tolist() for name, column in batch.items()}
+            leads = {lead: [c[f'radarState.{lead}.{name}'] for name, _ in LEAD_FIELDS] for lead in ('leadOne', 'leadTwo')}
+            for j, t in enumerate(c['t']):
+                car_state = SimpleNamespace(vEgo=c['carState.vEgo'][j], aEgo=c['carState.aEgo'][j],
+                                            steeringAngleDeg=c['carState.steeringAngleDeg'][j],
+                                            leftBlinker=c['carState.leftBlinker'][j], rightBlinker=c['carState.rightBlinker'][j],
+                                            gasPressed=c['carState.gasPressed'][j], brakePressed=c['carState.brakePressed'][j],
+                                            cruiseState=SimpleNamespace(enabled=c['carState.cruiseState.enabled'][j]))
+                controls_state = SimpleNamespace(longControlState=long_control_states[c['controlsState.longControlState'][j]],
+                                                 vCruise=c['controlsState.vCruise'][j], forceDecel=c['controlsState.forceDecel'][j],
+                                                 active=c['controlsState.active'][j])
+                radar_state = SimpleNamespace(**{lead: SimpleNamespace(**{name: values[j] for (name, _), values in zip(LEAD_FIELDS, lead_values)})
+                                                 for lead, lead_values in leads.items()})
+                yield t / 1e9, {'carState': car_state, 'controlsState': controls_state, 'radarState': radar_state}
+
+
+def append_drives(store, drives, rows=rlog_rows):
+    """Converts each drive, a list of rlog paths, and appends it to the store. Returns the rows added"""
+    os.makedirs(store, exist_ok=True)
+    index_path = os.path.join(store, 'index.json')
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('index_version') != INDEX_VERSION:
+            raise Exception(f'Unsupported drive store version {index.get("index_version")}')
+    else:
+        index = {'index_version': INDEX_VERSION, 'rows': 0, 'drives': [],
+                 'columns': {name: np.dtype(dtype).newbyteorder('<').str for name, (_, _, dtype) in COLUMNS.items()}}
+    if list(index['columns']) != list(COLUMNS):
+        raise Exception(f'{store} has other columns, convert to a new store')
+
+    names = list(COLUMNS)
+    dtypes = [np.dtype(index['columns'][name]) for name in names]
+    files = []
+    try:
+        for name, dtype in zip(names, dtypes):
+            f = open(os.path.join(store, f'{name}.bin'), 'ab')
+            f.truncate(index['rows'] * dtype.itemsize)
+            files.append(f)
+
+        added = 0
+        for paths in drives:
+            start = index['rows']
+            # Rows go out a chunk at a time, one array per column
+            chunk = []
+            for row in rows(paths):
+                chunk.append(row)
+                if len(chunk) == 65536:
+                    _write_chunk(files, dtypes, chunk)
+                    index['rows'] += len(chunk)
+                    chunk = []
+            if chunk:
+                _write_chunk(files, dtypes, chunk)
+                index['rows'] += len(chunk)
+            for f in files:
+                f.flush()
+            index['drives'].append({'source': [os.path.abspath(p) for p in paths], 'rows': [start, index['rows']]})
+            added += index['rows'] - start
+
+            tmp_path = f'{index_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp_path, index_path)
+            print(f"{paths[0] if len(paths) == 1 else os.path.dirname(paths[0])}: {index['rows'] - start} rows")
+    finally:
+        for f in files:
+            f.close()
+    return added
+
+
+def _write_chunk(files, dtypes, chunk):
+    for f, dtype, values in zip(files, dtypes, zip(*chunk)):
+        np.asarray(values, dtype=dtype).tofile(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store', help='store directory, created if missing')
+    parser.add_argument('drives', nargs='*', help='rlogs or directories of a drive\'s segment rlogs')
+    parser.add_argument('--openpilot', help='openpilot checkout for its logreader, defaults to $OPENPILOT_PATH')
+    parser.add_argument('--info', action='store_true', help='print the drives in the store')
+    args = parser.parse_args()
+
+    if args.drives:
+        from devtools import openpilot_env
+        openpilot_env.setup(args.openpilot)
+        added = append_drives(args.store, [_drive_paths(path) for path in args.drives])
+        print(f'{added} rows added')
+    if args.info:
+        store = DriveColumns(args.store)
+        for i, (start, stop) in enumerate(store.drives):
+            t = store.columns['t'][start:stop]
+            duration = (t[-1] - t[0]) / 1e9 if stop > start else 0.
+            print(f"{i}: {stop - start} rows, {duration:.0f} s, {store.index['drives'][i]['source'][0]}")
+
+
+if __name__ == '__main__':
+    main()
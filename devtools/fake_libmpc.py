@@ -0,0 +1,86 @@
+"""
+Pure Python stand-in for the libmpc cffi interface declared in
+src/longitudinal_mpc/libmpc_py.py. It follows the lead with a simple
+gap/speed feedback law instead of solving the ACADO problem, which is
+enough to exercise the planner on machines where the ARM .so can't load.
+"""
+import numpy as np
+
+N = 20
+# 0.2 s for the first 5 steps, 0.6 s after, as in longitudinal_mpc.c
+DT = np.array([0.2] * 5 + [0.6] * (N - 4))
+T = np.concatenate([[0.], np.cumsum(DT[:-1])])
+
+A_MIN = -3.5
+A_MAX = 2.0
+K_GAP = 0.15
+K_SPEED = 0.6
+
+
+class FakeLibmpc:
+    """Pass as libmpc_factory to openpilot_env.setup, it's called as FakeLibmpc(ffi, mpc_id)."""
+    def __init__(self, ffi, mpc_id):
+        from selfdrive.controls.lib.longitudinal_mpc.libmpc_py import solution_view
+        self.ffi = ffi
+        self.mpc_id = mpc_id
+        self.solution_view = solution_view
+
+        self.distance_cost = 0.
+        self.n_init = 0
+        self.n_init_with_simulation = 0
+        self.n_change_costs = 0
+        self.n_init_with_solution = 0
+        self.n_run_mpc = 0
+
+    def init(self, ttcCost, distanceCost, accelerationCost, jerkCost):
+        self.distance_cost = distanceCost
+        self.n_init += 1
+
+    def init_with_simulation(self, v_ego, x_l, v_l, a_l, l):
+        self.n_init_with_simulation += 1
+
+    def change_costs(self, ttcCost, distanceCost, accelerationCost, jerkCost):
+        self.distance_cost = distanceCost
+        self.n_change_costs += 1
+
+    def init_with_solution(self, solution):
+        self.n_init_with_solution += 1
+
+    def run_mpc(self, x0, solution, l, a_l_0, TR):
+        self.n_run_mpc += 1
+        sol = self.solution_view(self.ffi, solution)
+        x0 = x0[0]
+
+        # Lead prediction, same recurrence as run_mpc in longitudinal_mpc.c
+        x_l, v_l, a_l = x0.x_l, x0.v_l, a_l_0
+        x_ego, v_ego, a_ego = x0.x_ego, x0.v_ego, x0.a_ego
+        for i in range(N + 1):
+            t = T[i]
+            dt = DT[i] if i < N else 0.
+            sol['x_l'][i] = x_l
+            sol['v_l'][i] = v_l
+            sol['a_l'][i] = a_l
+            sol['t'][i] = t
+            sol['x_ego'][i] = x_ego
+            sol['v_ego'][i] = v_ego
+            sol['a_ego'][i] = a_ego
+
+            a_l = a_l_0 * np.exp(-l * t * t / 2)
+            x_l += v_l * dt
+            v_l += a_l * dt
+            if v_l < 0.:
+                a_l = 0.
+                v_l = 0.
+
+            desired_gap = 4. + TR * v_ego
+            a_new = K_GAP * (x_l - x_ego - desired_gap) + K_SPEED * (v_l - v_ego)
+            a_new = min(max(a_new, A_MIN), A_MAX)
+            if i < N:
+                sol['j_ego'][i] = (a_new - a_ego) / dt
+            a_ego = a_new
+            v_ego = max(v_ego + a_ego * dt, 0.)
+            x_ego += v_ego * dt
+
+        sol['cost'] = self.distance_cost * float(np.sum(np.square(sol['a_ego'])))
+        return 1
+
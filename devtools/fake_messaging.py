@@ -0,0 +1,115 @@
+"""
+In-process replacements for cereal's SubMaster/PubMaster plus the message
+sequences used to drive the planner off-device.
+"""
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+
+PLANNER_SERVICES = ['carState', 'controlsState', 'radarState', 'modelV2']
+
+
+class FakeSubMaster:
+    def __init__(self, services=PLANNER_SERVICES):
+        self.data = {}
+        self.logMonoTime = {s: 0 for s in services}
+        self.rcv_time = {s: 0. for s in services}
+        self.updated = {s: False for s in services}
+
+    def __getitem__(self, service):
+        return self.data[service]
+
+    def update_msgs(self, cur_time, msgs):
+        for s in self.updated:
+            self.updated[s] = False
+        for s, msg in msgs.items():
+            self.data[s] = msg
+            self.logMonoTime[s] = int(cur_time * 1e9)
+            self.rcv_time[s] = cur_time
+            self.updated[s] = True
+
+    def all_alive_and_valid(self, service_list=None):
+        return True
+
+
+class FakePubMaster:
+    def __init__(self):
+        self.sent = Counter()
+        self.last = {}
+
+    def send(self, service, dat):
+        self.sent[service] += 1
+        self.last[service] = dat
+
+
+def fake_CP():
+    return SimpleNamespace(radarTimeStep=0.05, minSpeedCan=0.3, startAccel=1.2,
+                           steerRatio=15.3, wheelbase=2.7)
+
+
+def lead(status=False, d_rel=0., v_lead=0., a_lead=0., y_rel=0., v_lat=0., fcw=False):
+    """fcw: radard's flag for a lead FCWChecker should evaluate"""
+    return SimpleNamespace(status=status, dRel=d_rel, vLead=v_lead, vLeadK=v_lead,
+                           aLeadK=a_lead, aLeadTau=1.5, yRel=y_rel, vLat=v_lat, fcw=fcw)
+
+
+def synthetic_drive(n_ticks, long_control_state, dt=0.05, seed=0):
+    """
+    Yields (t, {service: msg}) for a drive that alternates between open road,
+    following a lead with varying speed and a stop and go, with an occasional
+    second lead. long_control_state is the value used when engaged.
+    """
+    rng = np.random.default_rng(seed)
+    v_ego = 20.
+    a_ego = 0.
+    x_lead = 40.
+    v_lead = 18.
+    lead_two_until = 0.
+    for i in range(n_ticks):
+        t = i * dt
+        phase = (t // 60) % 3
+        if phase == 0:  # no lead, cruising
+            has_lead = False
+            v_target = 29.
+        elif phase == 1:  # highway following
+            has_lead = True
+            v_lead = max(v_lead + rng.normal(0., 0.15), 10.)
+            v_target = v_lead
+        else:  # stop and go
+            has_lead = True
+            v_lead = max(8. + 8. * np.sin(t / 6.), 0.)
+            v_target = v_lead
+
+        a_ego = float(np.clip(0.3 * (v_target - v_ego), -3., 1.5))
+        v_ego = max(v_ego + a_ego * dt, 0.)
+        x_lead = float(np.clip(x_lead + (v_lead - v_ego) * dt, 5., 120.))
+        if rng.random() < 0.002:
+            lead_two_until = t + rng.uniform(2., 10.)
+
+        car_state = SimpleNamespace(vEgo=v_ego, aEgo=a_ego, steeringAngleDeg=float(rng.normal(0., 2.)),
+                                    leftBlinker=False, rightBlinker=False, gasPressed=False,
+                                    brakePressed=False, cruiseState=SimpleNamespace(enabled=True))
+        controls_state = SimpleNamespace(longControlState=long_control_state, vCruise=110.,
+                                         forceDecel=False, active=True)
+        radar_state = SimpleNamespace(leadOne=lead(has_lead, x_lead, v_lead),
+                                      leadTwo=lead(t < lead_two_until, x_lead + 30., v_lead + 1.))
+        yield t, {'carState': car_state, 'controlsState': controls_state, 'radarState': radar_state}
+
+
+def rlog_drive(paths):
+    """
+    Yields (t, {service: msg}) from recorded rlogs, one item per radarState with
+    the latest carState/controlsState seen before it.
+    Needs openpilot's tools.lib.logreader on the path.
+    """
+    from tools.lib.logreader import LogReader
+
+    latest = {}
+    for path in paths:
+        for msg in LogReader(path):
+            which = msg.which()
+            if which in ('carState', 'controlsState'):
+                latest[which] = getattr(msg, which)
+            elif which == 'radarState' and len(latest) == 2:
+                yield msg.logMonoTime / 1e9, dict(latest, radarState=msg.radarState)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Checks FCWPrescreen and fcw_prescreen.evaluate_drive against openpilot's own FCWChecker.
+
+Each drive is random inputs held for 40 tick blocks, with planned decels around the
+checker's thresholds, lead drop-outs, new leads and blinkers. Every tick goes through
+FCWChecker.update and through FCWPrescreen on a second checker, which must leave the same
+counters and alerts. evaluate_drive over the whole drive must then give the same alerts,
+none of them on a tick it calls clearly safe. Rerun it when openpilot is bumped.
+
+  python -m devtools.fcw_prescreen_check --openpilot ~/openpilot --drives 40  # exits 1 on a mismatch
+"""
+import argparse
+import sys
+
+import numpy as np
+
+from devtools import openpilot_env
+
+BLOCK = 40  # ticks
+# Planned accel at the end of the horizon, ramped from 0 over it
+BASE_ACCELS = [0.2, -0.5, -1.2, -1.9, -2.5]
+
+
+def _blocks(n, draw):
+    return np.repeat(draw(n // BLOCK + 1), BLOCK)[:n]
+
+
+def random_drive(seed, n):
+    """Per tick inputs of FCWChecker.update and evaluate_drive, solutions as log_t records"""
+    from selfdrive.controls.lib.longitudinal_mpc.libmpc_py import LOG_T_DTYPE
+
+    rng = np.random.default_rng(seed)
+    solutions = np.zeros(n, LOG_T_DTYPE)
+    base = _blocks(n, lambda k: rng.choice(BASE_ACCELS, k)) + rng.normal(0., 0.05, n)
+    solutions['a_ego'] = base[:, None] * np.linspace(0., 1.5, 21)[None, :]
+    solutions['x_ego'] = np.cumsum(np.ones((n, 21)), axis=1)
+    solutions['x_l'] = solutions['x_ego'] + 20.
+    solutions['v_ego'] = 10.
+    solutions['v_l'] = 9.
+
+    v_ego = _blocks(n, lambda k: rng.uniform(3., 25., k))
+    return {
+        't': np.arange(n) * 0.05 + 100.,
+        'solutions': solutions,
+        'v_ego': v_ego,
+        'a_ego': _blocks(n, lambda k: rng.uniform(-2., 0.5, k)),
+        'x_lead': _blocks(n, lambda k: rng.uniform(3., 40., k)),
+        'v_lead': v_ego - _blocks(n, lambda k: rng.uniform(-1., 8., k)),
+        'a_lead': _blocks(n, lambda k: rng.uniform(-3., 1., k)),
+        'y_lead': _blocks(n, lambda k: rng.normal(0., 0.7, k)),
+        'vlat_lead': _blocks(n, lambda k: rng.normal(0., 0.3, k)),
+        'fcw_lead': (_blocks(n, lambda k: rng.random(k)) < 0.9).astype(np.float64),
+        'blinkers': rng.random(n) < 0.002,
+        'new_lead': rng.random(n) < 0.002,
+    }
+
+
+def check_drive(drive):
+    """Returns: (checker alerts per tick, ticks the prescreen skipped, list of mismatch descriptions)"""
+    from selfdrive.controls.lib.fcw import FCWChecker
+    from selfdrive.controls.lib.fcw_prescreen import FCWPrescreen, evaluate_drive
+    from selfdrive.controls.lib.longitudinal_mpc import libmpc_py
+
+    ffi = libmpc_py.get_ffi()
+    mpc_solution = ffi.new("log_t *")
+    solution = libmpc_py.solution_view(ffi, mpc_solution)
+    size = ffi.sizeof("log_t")
+
+    checker, screened, prescreen = FCWChecker(), FCWChecker(), FCWPrescreen()
+    n = len(drive['t'])
+    fcw = np.zeros(n, dtype=bool)
+    mismatches = []
+    names = ('t', 'v_ego', 'a_ego', 'x_lead', 'v_lead', 'a_lead', 'y_lead', 'vlat_lead', 'fcw_lead', 'blinkers')
+    columns = [drive[name].tolist() for name in names]
+    solutions = drive['solutions']
+    for i, (t, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead, fcw_lead, blinkers) in enumerate(zip(*columns)):
+        ffi.memmove(mpc_solution, solutions[i:i + 1].tobytes(), size)
+        if drive['new_lead'][i]:
+            checker.reset_lead(t)
+            screened.reset_lead(t)
+        args = (t, True, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead, fcw_lead, blinkers)
+        fcw[i] = checker.update(mpc_solution, *args)
+        screened_fcw = prescreen.update(screened, solution, mpc_solution, *args)
+        if not mismatches and (screened_fcw != fcw[i] or dict(screened.counters) != dict(checker.counters) or
+                               dict(screened.common_counters) != dict(checker.common_counters) or
+                               screened.v_lead_max != checker.v_lead_max):
+            mismatches.append(f'tick {i}: prescreen state first differs from FCWChecker')
+
+    result = evaluate_drive(drive['t'], solutions, *(drive[name] for name in names[1:]), drive['new_lead'])
+    if not (result.fcw == fcw).all():
+        mismatches.append(f'evaluate_drive alerts at {np.flatnonzero(result.fcw).tolist()}, '
+                          f'FCWChecker at {np.flatnonzero(fcw).tolist()}')
+    if (result.fcw & result.clearly_safe).any():
+        mismatches.append(f'alerts on clearly safe ticks {np.flatnonzero(result.fcw & result.clearly_safe).tolist()}')
+    return fcw, prescreen.skips, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--openpilot', help='openpilot checkout, defaults to $OPENPILOT_PATH')
+    parser.add_argument('--drives', type=int, default=40)
+    parser.add_argument('--ticks', type=int, default=6000, help='per drive, 20 Hz')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    openpilot_env.setup(args.openpilot)
+    from selfdrive.controls.lib import fcw
+    print(f'FCWChecker from {fcw.__file__}')
+
+    alerts, skips, failed = 0, 0, 0
+    for seed in range(args.seed, args.seed + args.drives):
+        drive_fcw, drive_skips, mismatches = check_drive(random_drive(seed, args.ticks))
+        alerts += int(drive_fcw.sum())
+        skips += drive_skips
+        for mismatch in mismatches:
+            print(f'seed {seed}: {mismatch}')
+        failed += bool(mismatches)
+
+    print(f'{args.drives} drives, {alerts} alerts, {failed} mismatching drives, '
+          f'prescreen skipped {skips / (args.drives * args.ticks):.0%} of ticks')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import os
+import sys
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src_path = f'{repo_path}/src'
+
+
+def setup(openpilot_path=None, libmpc_factory=None):
+    """
+    Makes the patched modules in src/ importable under their on-device names
+    (selfdrive.controls.lib.*) on top of an openpilot checkout.
+    Must be called before anything imports from selfdrive.controls.lib.
+    """
+    openpilot_path = openpilot_path or os.environ.get('OPENPILOT_PATH', '/data/openpilot')
+    if openpilot_path not in sys.path:
+        sys.path.insert(0, openpilot_path)
+
+    import selfdrive.controls.lib as lib
+    lib.__path__ = [src_path] + [p for p in lib.__path__ if p != src_path]
+
+    # src/longitudinal_mpc has no __init__.py, so it would be shadowed by the upstream package
+    import selfdrive.controls.lib.longitudinal_mpc as longitudinal_mpc
+    mpc_path = f'{src_path}/longitudinal_mpc'
+    longitudinal_mpc.__path__ = [mpc_path] + [p for p in longitudinal_mpc.__path__ if p != mpc_path]
+
+    if libmpc_factory is not None:
+        from selfdrive.controls.lib.longitudinal_mpc import libmpc_py
+        libmpc_py.set_libmpc_factory(libmpc_factory)
+
+
+MPC_BACKENDS = ['fake', 'acado', 'numpy']
+
+
+def use_mpc_backend(backend):
+    """
+    Solver for LongitudinalMpc instances created after this, after setup(). fake is the
+    FakeLibmpc stand-in, the others are libmpc_py backends
+    """
+    from selfdrive.controls.lib import long_mpc
+    from selfdrive.controls.lib.longitudinal_mpc import libmpc_py
+    if backend == 'fake':
+        from devtools.fake_libmpc import FakeLibmpc
+        libmpc_py.set_libmpc_factory(FakeLibmpc)
+        backend = libmpc_py.ACADO
+    long_mpc.MPC_BACKEND = backend
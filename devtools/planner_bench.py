@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Replay benchmark for Planner.update/Planner.publish.
+
+Drives the patched planner from synthetic or recorded carState/controlsState/
+radarState sequences with in-process messaging, a stand-in libmpc and the
+button/brightness paths pointed at temp files, then reports per-tick latency
+percentiles, memory allocated per tick and a per-stage breakdown.
+
+  python -m devtools.planner_bench --openpilot ~/openpilot --ticks 5000
+  python -m devtools.planner_bench --rlog rlog.bz2 --json bench_output.txt
+  python -m devtools.planner_bench --columns store/  # drives converted by devtools.drive_columns
+  python -m devtools.planner_bench --baseline old.json  # exits 1 on regression
+  python -m devtools.planner_bench --backend numpy  # the NumPy reference solver instead of the stand-in
+"""
+import argparse
+from collections import defaultdict
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from devtools import openpilot_env
+from devtools.drive_columns import DriveColumns
+from devtools.fake_messaging import FakePubMaster, FakeSubMaster, fake_CP, rlog_drive, synthetic_drive
+
+STAGES = ['cruise', 'mpc1', 'mpc2', 'choose_solution', 'fcw', 'publish']
+
+
+class StageTimer:
+    def __init__(self):
+        self.tick = defaultdict(int)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            t = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.tick[stage] += time.perf_counter_ns() - t
+        return timed
+
+    def take(self):
+        tick = dict(self.tick)
+        self.tick.clear()
+        return tick
+
+
+class StubbedIO:
+    """FIFO for the volume button, temp files for the backlight and the plan ring."""
+    def __init__(self, lp):
+        self.tmp = tempfile.TemporaryDirectory()
+        lp.PATCH_PATH = self.tmp.name
+        lp.BUTTON_PATH = f'{self.tmp.name}/event0'
+        lp.BRIGHTNESS_PATH = f'{self.tmp.name}/brightness'
+        lp.PLAN_RING_PATH = f'{self.tmp.name}/plan_ring'
+        os.mkfifo(lp.BUTTON_PATH)
+        # Hold a writer so the button reader waits instead of seeing EOF
+        self.button_fd = os.open(lp.BUTTON_PATH, os.O_RDWR)
+        with open(lp.BRIGHTNESS_PATH, 'w') as f:
+            f.write('100')
+
+    def close(self, planner):
+        planner.stop()
+        os.close(self.button_fd)
+        self.tmp.cleanup()
+
+
+def make_planner(lp, timer):
+    CP = fake_CP()
+    planner = lp.Planner(CP)
+    for name in ['calc_cruise_accel_limits', 'limit_accel_in_turns', 'speed_smoother']:
+        setattr(lp, name, timer.wrap('cruise', getattr(lp, name)))
+    planner.mpc1.update = timer.wrap('mpc1', planner.mpc1.update)
+    planner.mpc2.update = timer.wrap('mpc2', planner.mpc2.update)
+    planner.choose_solution = timer.wrap('choose_solution', planner.choose_solution)
+    planner.fcw_checker.update = timer.wrap('fcw', planner.fcw_checker.update)
+    planner.publish = timer.wrap('publish', planner.publish)
+    return CP, planner
+
+
+def run(lp, drive, warmup, trace_allocs):
+    timer = StageTimer()
+    io = StubbedIO(lp)
+    CP, planner = make_planner(lp, timer)
+    sm = FakeSubMaster()
+    pm = FakePubMaster()
+
+    totals = []
+    stages = defaultdict(list)
+    allocs = defaultdict(list)
+    try:
+        for i, (t, msgs) in enumerate(drive):
+            sm.update_msgs(t, msgs)
+            if trace_allocs:
+                tracemalloc.clear_traces()
+                tracemalloc.reset_peak()
+            start = time.perf_counter_ns()
+            planner.update(sm, CP)
+            planner.publish(sm, pm)
+            total = time.perf_counter_ns() - start
+            if trace_allocs:
+                # Traces start empty each tick: the peak is the most the tick's allocations held at once,
+                # the snapshot what of them is still alive after it
+                allocs['peak_bytes'].append(tracemalloc.get_traced_memory()[1])
+                allocs['live_blocks'].append(len(tracemalloc.take_snapshot().traces))
+            tick = timer.take()
+            if i < warmup:
+                continue
+            totals.append(total)
+            for stage in STAGES:
+                stages[stage].append(tick.get(stage, 0))
+    finally:
+        io.close(planner)
+    counters = {}
+    for name, mpc in (('mpc1', planner.mpc1), ('mpc2', planner.mpc2)):
+        for attr in ('no_lead_hits', 'no_lead_misses', 'warm_resets', 'cold_resets'):
+            counters[f'{name}_{attr}'] = getattr(mpc, attr)
+        counters[f'{name}_cost_changes'] = mpc.dynamic_follow.cost_changes
+        for i, kind in enumerate(('steady', 'cost_change')):
+            counters[f'{name}_n_its_{kind}'] = mpc.n_its_sum[i] / max(mpc.n_its_count[i], 1)
+    return np.array(totals), {s: np.array(v) for s, v in stages.items()}, {k: np.array(v[warmup:]) for k, v in allocs.items()}, counters
+
+
+def summarize(ns):
+    us = ns / 1e3
+    return {'p50': float(np.percentile(us, 50)), 'p99': float(np.percentile(us, 99)),
+            'max': float(us.max()), 'mean': float(us.mean())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--openpilot', help='openpilot checkout, defaults to $OPENPILOT_PATH')
+    parser.add_argument('--rlog', nargs='*', help='replay these rlogs instead of a synthetic drive')
+    parser.add_argument('--columns', help='replay the drives of this drive_columns store instead of a synthetic drive')
+    parser.add_argument('--ticks', type=int, default=4000, help='synthetic drive length at 20 Hz')
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=openpilot_env.MPC_BACKENDS, default='fake', help='mpc solver')
+    parser.add_argument('--json', help='write results here')
+    parser.add_argument('--baseline', help='results from a previous --json run to compare p99 against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='allowed p99 ratio over baseline')
+    args = parser.parse_args()
+
+    openpilot_env.setup(args.openpilot)
+    openpilot_env.use_mpc_backend(args.backend)
+    from selfdrive.controls.lib import longitudinal_planner as lp
+    from selfdrive.controls.lib.longcontrol import LongCtrlState
+    from selfdrive.controls.lib.planner_stats import stats
+
+    def drive():
+        if args.rlog:
+            return rlog_drive(args.rlog)
+        if args.columns:
+            return DriveColumns(args.columns).messages()
+        return synthetic_drive(args.ticks, LongCtrlState.pid, seed=args.seed)
+
+    totals, stages, _, counters = run(lp, drive(), args.warmup, trace_allocs=False)
+    planner_stats = stats.snapshot(reset=True)  # the planner's own instrumentation, warmup included
+    tracemalloc.start()
+    _, _, allocs, _ = run(lp, drive(), args.warmup, trace_allocs=True)
+    tracemalloc.stop()
+
+    results = {
+        'ticks': len(totals),
+        'total_us': summarize(totals),
+        'stages_us': {s: summarize(v) for s, v in stages.items()},
+        'peak_bytes_per_tick': {'mean': float(allocs['peak_bytes'].mean()), 'max': int(allocs['peak_bytes'].max())},
+        'live_blocks_per_tick': {'mean': float(allocs['live_blocks'].mean()), 'max': int(allocs['live_blocks'].max())},
+        'counters': counters,
+        'planner_stats': planner_stats,
+    }
+
+    print(f"{results['ticks']} ticks")
+    print(f"{'stage':<16}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+    for name, s in [('total', results['total_us'])] + list(results['stages_us'].items()):
+        print(f"{name:<16}{s['p50']:>10.1f}{s['p99']:>10.1f}{s['max']:>10.1f}")
+    print(f"peak bytes allocated per tick: mean {results['peak_bytes_per_tick']['mean']:.0f} max {results['peak_bytes_per_tick']['max']}")
+    print(f"blocks still live after a tick: mean {results['live_blocks_per_tick']['mean']:.1f} max {results['live_blocks_per_tick']['max']}")
+    for name, value in counters.items():
+        print(f'{name}: {value}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = []
+        for name, s in [('total', results['total_us'])] + list(results['stages_us'].items()):
+            old = baseline['total_us'] if name == 'total' else baseline['stages_us'].get(name)
+            if old is not None and s['p99'] > old['p99'] * args.tolerance:
+                regressed.append(f"{name}: p99 {old['p99']:.1f} -> {s['p99']:.1f} us")
+        for line in regressed:
+            print(f'REGRESSION {line}')
+        sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
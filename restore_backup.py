@@ -1,14 +1,49 @@
 import os
-import shutil
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'util'))
+from file_hashing import DigestCache, hash_files
+from install_manifest import INSTALLED, RESTORED, RESTORING, FileSwap, Manifest, load_manifest, path_stat_key, \
+                             recover
 
 disk_path = '/data/openpilot/selfdrive/controls/lib'
 backup_path = '/data/openpilot-patch/backup'
+cache_path = '/data/openpilot-patch/hash_cache.json'
+manifest_path = '/data/openpilot-patch/manifest.json'
+
+manifest = recover(load_manifest(manifest_path), manifest_path, disk_path, print)
+swap = FileSwap(disk_path, print)
+
+if manifest is None or manifest.state != INSTALLED:
+    # No record of a clean install, put back whatever was backed up
+    manifest = manifest or Manifest(RESTORING)
+    for (parent, dirs, files) in os.walk(backup_path):
+        for file in files:
+            backup_full_path = f'{parent}/{file}'
+            swap.stage(os.path.relpath(backup_full_path, backup_path), backup_full_path)
+else:
+    # Only files changed since the install need hashing
+    changed = [rel_path for rel_path, entry in manifest.entries.items()
+               if path_stat_key(f'{disk_path}/{rel_path}') != entry.installed_stat]
+    digests = hash_files([f'{disk_path}/{rel_path}' for rel_path in changed], DigestCache(cache_path))
+    for entry in manifest.entries.values():
+        if entry.rel_path in changed:
+            md5 = digests[f'{disk_path}/{entry.rel_path}'].md5
+            if md5 == entry.orig_md5:
+                print(f'{entry.rel_path} is already original')
+                continue
+            elif md5 != entry.installed_md5:
+                print(f'{entry.rel_path} has unknown hash {md5}, leaving it')
+                continue
+        if entry.orig_md5 is None:
+            swap.stage_removal(entry.rel_path)
+        elif os.path.exists(f'{backup_path}/{entry.rel_path}'):
+            swap.stage(entry.rel_path, f'{backup_path}/{entry.rel_path}')
+        else:
+            print(f'{entry.rel_path} has no backup, leaving it')
 
-for (parent, dirs, files) in os.walk(backup_path):
-    for file in files:
-        backup_full_path = f'{parent}/{file}'
-        disk_full_path = backup_full_path.replace(backup_path, disk_path)
-        if os.path.exists(disk_full_path):
-            os.remove(disk_full_path)
-        shutil.copy(backup_full_path, disk_full_path)
-        print(f'{backup_full_path} restored')
+swap.begin(manifest, manifest_path, RESTORING)
+swap.swap()
+manifest.state = RESTORED
+swap.commit(manifest)
+print('Restored')
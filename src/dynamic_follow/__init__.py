@@ -1,21 +1,40 @@
+import math
+import time
+
 import cereal.messaging as messaging
 from common.realtime import sec_since_boot
 from selfdrive.controls.lib.drive_helpers import MPC_COST_LONG
-from common.numpy_fast import interp, clip
+from common.numpy_fast import clip
 from selfdrive.config import Conversions as CV
+from selfdrive.controls.lib.lookup_table import LookupTable
+from selfdrive.controls.lib.planner_stats import stats
 
 from selfdrive.controls.lib.dynamic_follow.support import LeadData, CarData, dfData
 travis = False
 
+# Distance costs are pushed to the solver quantized to COST_STEP in log10 space and only
+# once the interpolated cost moves more than COST_HYSTERESIS (log10) from the last pushed one
+COST_STEP = 0.01  # ~2.3%
+COST_HYSTERESIS = 0.02  # ~4.7%
+
+_X_VEL = [0.0, 1.892, 3.7432, 5.8632, 8.0727, 10.7301, 14.343, 17.6275, 22.4049, 28.6752, 34.8858, 40.35]
+_Y_DIST = [1.3781, 1.3791, 1.3457, 1.3134, 1.3145, 1.318, 1.3485, 1.257, 1.144, 0.979, 0.9461, 0.9156]
+_TR_BY_SPEED = LookupTable(_X_VEL, _Y_DIST)
+_DISTANCE_COST_BY_TR = LookupTable([0.9, 1.8, 2.7], [1., 0.1, 0.01])
+
+DMC_V_REL_PARAMS = dict(k_i=0.042, k_d=0.08, x_clip=[-1, 0, 0.66], mods=[1.15, 1., 0.95])
+DMC_A_REL_PARAMS = dict(k_i=0.042 * 1.05, k_d=0.08, x_clip=[-1, 0, 0.33], mods=[1.15, 1., 0.98])  # a_lead loop is 5% faster
+
 
 class DistanceModController:
   def __init__(self, k_i, k_d, x_clip, mods):
     self._rate = 1 / 20.
+    self._reset_time = 15  # in x seconds i goes from max to 0
 
     self._k_i = k_i
     self._k_d = k_d
     self._to_clip = x_clip  # reaches this with v_rel=3.5 mph for 4 seconds
-    self._mods = mods
+    self._mods = LookupTable(x_clip, mods)
 
     self.i = 0  # never resets, even when new lead
     self.last_error = 0
@@ -34,23 +53,22 @@ class DistanceModController:
     self.i = clip(self.i, self._to_clip[0], self._to_clip[-1])  # clip to reasonable range
     self._slow_reset()  # slowly reset from max to 0
 
-    fact = interp(self.i, self._to_clip, self._mods)
+    fact = self._mods(self.i)
     self.last_error = float(error)
 
     return fact
 
   def _slow_reset(self):
     if abs(self.i) > 0.01:  # oscillation starts around 0.006
-      reset_time = 15  # in x seconds i goes from max to 0
       sign = 1 if self.i > 0 else -1
-      self.i -= sign * max(self._to_clip) / (reset_time / self._rate)
+      self.i -= sign * max(self._to_clip) / (self._reset_time / self._rate)
 
 
 class DynamicFollow:
   def __init__(self, mpc_id):
     self.mpc_id = mpc_id
-    self.dmc_v_rel = DistanceModController(k_i=0.042, k_d=0.08, x_clip=[-1, 0, 0.66], mods=[1.15, 1., 0.95])
-    self.dmc_a_rel = DistanceModController(k_i=0.042 * 1.05, k_d=0.08, x_clip=[-1, 0, 0.33], mods=[1.15, 1., 0.98])  # a_lead loop is 5% faster
+    self.dmc_v_rel = DistanceModController(**DMC_V_REL_PARAMS)
+    self.dmc_a_rel = DistanceModController(**DMC_A_REL_PARAMS)
 
     # Dynamic follow variables
     self.default_TR = 1.8
@@ -60,6 +78,12 @@ class DynamicFollow:
 
     self.sng_TR = 1.8  # reacceleration stop and go TR
     self.sng_speed = 18.0 * CV.MPH_TO_MS
+    # decrease TR between 12.6 and 18 mph from 1.8s to defined TR above at 18mph while accelerating
+    self._sng_TR_by_speed = LookupTable([self.sng_speed * 0.7, self.sng_speed], [self.sng_TR, _TR_BY_SPEED(self.sng_speed)])
+
+    self.cost_changes = 0
+    self.cost_changed = False  # during the last update
+    self.update_time = stats.histogram(f'df{mpc_id}.update')
 
     self._setup_changing_variables()
 
@@ -69,11 +93,12 @@ class DynamicFollow:
     self.sng = False
     self.car_data = CarData()
     self.lead_data = LeadData()
-    self.df_data = dfData()  # dynamic follow data
+    self.df_data = dfData(self.v_ego_retention, self.v_rel_retention)  # dynamic follow data
 
     self.last_cost = 0.0
 
   def update(self, CS, libmpc):
+    start = time.monotonic_ns()
     self._update_car(CS)
 
     if not self.lead_data.status:
@@ -85,57 +110,50 @@ class DynamicFollow:
     if not travis:
       self._change_cost(libmpc)
 
+    self.update_time.add(time.monotonic_ns() - start)
     return self.TR
 
   def _change_cost(self, libmpc):
-    TRs = [0.9, 1.8, 2.7]
-    costs = [1., 0.1, 0.01]
-    cost = interp(self.TR, TRs, costs)
+    cost = _DISTANCE_COST_BY_TR(self.TR)
 
-    if self.last_cost != cost:
+    self.cost_changed = self.last_cost == 0.0 or abs(math.log10(cost / self.last_cost)) > COST_HYSTERESIS
+    if self.cost_changed:
+      cost = 10 ** (round(math.log10(cost) / COST_STEP) * COST_STEP)
       libmpc.change_costs(MPC_COST_LONG.TTC, cost, MPC_COST_LONG.ACCELERATION, MPC_COST_LONG.JERK)  # todo: jerk is the derivative of acceleration, could tune that
       self.last_cost = cost
+      self.cost_changes += 1
 
   def _store_df_data(self):
     cur_time = sec_since_boot()
     # Store custom relative accel over time
     if self.lead_data.status:
       if self.lead_data.new_lead:
-        self.df_data.v_rels = []  # reset when new lead
+        self.df_data.v_rels.clear()  # reset when new lead
       else:
-        self.df_data.v_rels = self._remove_old_entries(self.df_data.v_rels, cur_time, self.v_rel_retention)
-      self.df_data.v_rels.append({'v_ego': self.car_data.v_ego, 'v_lead': self.lead_data.v_lead, 'time': cur_time})
+        self.df_data.v_rels.expire(cur_time)
+      self.df_data.v_rels.append(cur_time, self.car_data.v_ego, self.lead_data.v_lead)
 
     # Store our velocity for better sng
-    self.df_data.v_egos = self._remove_old_entries(self.df_data.v_egos, cur_time, self.v_ego_retention)
-    self.df_data.v_egos.append({'v_ego': self.car_data.v_ego, 'time': cur_time})
-
-  @staticmethod
-  def _remove_old_entries(lst, cur_time, retention):
-    return [sample for sample in lst if cur_time - sample['time'] <= retention]
+    self.df_data.v_egos.expire(cur_time)
+    self.df_data.v_egos.append(cur_time, self.car_data.v_ego)
 
   def _get_TR(self):
-    x_vel = [0.0, 1.892, 3.7432, 5.8632, 8.0727, 10.7301, 14.343, 17.6275, 22.4049, 28.6752, 34.8858, 40.35]
-    y_dist = [1.3781, 1.3791, 1.3457, 1.3134, 1.3145, 1.318, 1.3485, 1.257, 1.144, 0.979, 0.9461, 0.9156]
-
     v_rel_dist_factor = self.dmc_v_rel.update(self.lead_data.v_lead - self.car_data.v_ego)
     a_lead_dist_factor = self.dmc_a_rel.update(self.lead_data.a_lead - self.car_data.a_ego)
 
-    TR = interp(self.car_data.v_ego, x_vel, y_dist)
+    TR = _TR_BY_SPEED(self.car_data.v_ego)
     TR *= v_rel_dist_factor
     TR *= a_lead_dist_factor
 
     if self.car_data.v_ego > self.sng_speed:  # keep sng distance until we're above sng speed again
       self.sng = False
 
-    if (self.car_data.v_ego >= self.sng_speed or self.df_data.v_egos[0]['v_ego'] >= self.car_data.v_ego) and not self.sng:
+    if (self.car_data.v_ego >= self.sng_speed or self.df_data.v_egos.oldest('v_ego') >= self.car_data.v_ego) and not self.sng:
       # if above 15 mph OR we're decelerating to a stop, keep shorter TR. when we reaccelerate, use sng_TR and slowly decrease
-      TR = interp(self.car_data.v_ego, x_vel, y_dist)
+      TR = _TR_BY_SPEED(self.car_data.v_ego)
     else:  # this allows us to get closer to the lead car when stopping, while being able to have smooth stop and go when reaccelerating
       self.sng = True
-      x = [self.sng_speed * 0.7, self.sng_speed]  # decrease TR between 12.6 and 18 mph from 1.8s to defined TR above at 18mph while accelerating
-      y = [self.sng_TR, interp(self.sng_speed, x_vel, y_dist)]
-      TR = interp(self.car_data.v_ego, x, y)
+      TR = self._sng_TR_by_speed(self.car_data.v_ego)
 
     return float(clip(TR, 1.0, 2.7))
 
@@ -0,0 +1,125 @@
+"""
+Offline evaluation of DynamicFollow over whole drives. Gives the same TR as calling
+DynamicFollow.update tick by tick with the same inputs and timestamps, bit for bit.
+Only the recursive parts (distance mod controllers and the sng flag) run in a Python
+loop, the rest is vectorized.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from common.numpy_fast import clip
+from selfdrive.controls.lib.lookup_table import LookupTable
+from selfdrive.controls.lib.dynamic_follow import DynamicFollow, DistanceModController, DMC_V_REL_PARAMS, DMC_A_REL_PARAMS, \
+                                                 _X_VEL, _Y_DIST
+
+DFBatchResult = namedtuple('DFBatchResult', ['TR', 'v_rel_factor', 'a_rel_factor', 'sng', 'oldest_v_ego'])
+
+
+def default_params():
+  df = DynamicFollow(0)
+  return {
+    'x_vel': list(_X_VEL),
+    'y_dist': list(_Y_DIST),
+    'default_TR': df.default_TR,
+    'sng_TR': df.sng_TR,
+    'sng_speed': df.sng_speed,
+    'v_ego_retention': df.v_ego_retention,
+    'history_capacity': df.df_data.v_egos.capacity,
+    'dmc_v_rel': dict(DMC_V_REL_PARAMS),
+    'dmc_a_rel': dict(DMC_A_REL_PARAMS),
+  }
+
+
+def lead_inputs(v_lead, a_lead):
+  """The lead filtering LongitudinalMpc.update applies before passing a radar lead to DynamicFollow"""
+  v_lead = np.maximum(0.0, v_lead)
+  stopped = (v_lead < 0.1) | (-a_lead / 2.0 > v_lead)
+  return np.where(stopped, 0.0, v_lead), np.where(stopped, 0.0, a_lead)
+
+
+def dmc_factors(errors, k_i, k_d, x_clip, mods):
+  """DistanceModController.update over a sequence of errors"""
+  dmc = DistanceModController(k_i, k_d, x_clip, mods)
+  rate, lo, hi = dmc._rate, x_clip[0], x_clip[-1]
+  reset_step = max(x_clip) / (dmc._reset_time / rate)
+
+  i = dmc.i
+  last_error = dmc.last_error
+  i_out = []
+  for error in errors.tolist():
+    d = k_d * (error - last_error)
+    if d < 0:
+      i += d
+    i += error * rate * k_i
+    i = clip(i, lo, hi)
+    if abs(i) > 0.01:
+      i -= (1 if i > 0 else -1) * reset_step
+    i_out.append(i)
+    last_error = error
+  return dmc._mods.batch(np.array(i_out, dtype=np.float64))
+
+
+def oldest_in_window(t, retention, capacity):
+  """Index of the oldest sample TimedRingBuffer still holds after each append"""
+  n = len(t)
+  idx = np.searchsorted(t, t - retention, side='left')
+  # searchsorted compares t[j] >= t[i] - retention, the buffer t[i] - t[j] <= retention. Fix up rounding at the edge
+  idx = np.minimum(idx, np.arange(n))
+  for _ in range(2):
+    prev = np.maximum(idx - 1, 0)
+    idx = np.where((idx > 0) & (t - t[prev] <= retention), prev, idx)
+    idx = np.where(t - t[idx] > retention, idx + 1, idx)
+  return np.maximum(idx, np.arange(n) - capacity + 1)
+
+
+def evaluate_drive(t, v_ego, a_ego, v_lead, a_lead, lead_status, params=None):
+  """
+  Runs DynamicFollow over a drive. Inputs are per tick arrays, v_lead/a_lead as DynamicFollow
+  gets them (see lead_inputs), lead_status boolean. t must be increasing.
+  Returns: DFBatchResult of per tick arrays, factors are NaN on ticks without a lead
+  """
+  p = default_params() if params is None else dict(default_params(), **params)
+  t, v_ego, a_ego, v_lead, a_lead = (np.asarray(x, dtype=np.float64) for x in (t, v_ego, a_ego, v_lead, a_lead))
+  lead_status = np.asarray(lead_status, dtype=bool)
+  n = len(t)
+
+  TR = np.full(n, p['default_TR'])
+  v_rel_factor = np.full(n, np.nan)
+  a_rel_factor = np.full(n, np.nan)
+  sng = np.zeros(n, dtype=bool)
+  oldest_v_ego = np.full(n, np.nan)
+
+  lead_idx = np.flatnonzero(lead_status)
+  if len(lead_idx) == 0:
+    return DFBatchResult(TR, v_rel_factor, a_rel_factor, sng, oldest_v_ego)
+
+  v = v_ego[lead_idx]
+  v_rel_factor[lead_idx] = dmc_factors(v_lead[lead_idx] - v, **p['dmc_v_rel'])
+  a_rel_factor[lead_idx] = dmc_factors(a_lead[lead_idx] - a_ego[lead_idx], **p['dmc_a_rel'])
+
+  # v_ego history only grows on ticks with a lead
+  oldest = v[oldest_in_window(t[lead_idx], p['v_ego_retention'], p['history_capacity'])]
+  oldest_v_ego[lead_idx] = oldest
+
+  tr_by_speed = LookupTable(p['x_vel'], p['y_dist'])
+  sng_speed = p['sng_speed']
+  sng_TR_by_speed = LookupTable([sng_speed * 0.7, sng_speed], [p['sng_TR'], tr_by_speed(sng_speed)])
+
+  sng_flag = False
+  sng_lead = []
+  for v_k, oldest_k in zip(v.tolist(), oldest.tolist()):
+    if v_k > sng_speed:
+      sng_flag = False
+    if not ((v_k >= sng_speed or oldest_k >= v_k) and not sng_flag):
+      sng_flag = True
+    sng_lead.append(sng_flag)
+  sng_lead = np.array(sng_lead, dtype=bool)
+
+  TR[lead_idx] = np.clip(np.where(sng_lead, sng_TR_by_speed.batch(v), tr_by_speed.batch(v)), 1.0, 2.7)
+
+  # sng is kept through ticks without a lead
+  sng[lead_idx] = sng_lead
+  last_lead = np.maximum.accumulate(np.where(lead_status, np.arange(n), -1))
+  sng = np.where(last_lead >= 0, sng[last_lead], False)
+  return DFBatchResult(TR, v_rel_factor, a_rel_factor, sng, oldest_v_ego)
@@ -1,20 +1,140 @@
+import numpy as np
+
+
 class LeadData:
-  v_lead = None
-  x_lead = None
-  a_lead = None
-  status = False
-  new_lead = False
+  __slots__ = ('v_lead', 'x_lead', 'a_lead', 'status', 'new_lead')
+
+  def __init__(self):
+    self.v_lead = None
+    self.x_lead = None
+    self.a_lead = None
+    self.status = False
+    self.new_lead = False
 
 
 class CarData:
-  v_ego = 0.0
-  a_ego = 0.0
+  __slots__ = ('v_ego', 'a_ego', 'left_blinker', 'right_blinker', 'cruise_enabled')
+
+  def __init__(self):
+    self.v_ego = 0.0
+    self.a_ego = 0.0
+
+    self.left_blinker = False
+    self.right_blinker = False
+    self.cruise_enabled = True
+
+
+class TimedRingBuffer:
+  """
+  Fixed capacity history of samples no older than retention seconds.
+  Append, expiry and oldest sample are O(1) (expiry amortized), running sums keep
+  windowed mean and slope O(1) too.
+  """
+  __slots__ = ('retention', 'capacity', '_cols', '_t', '_x', '_head', '_len',
+               '_t0', '_sum_t', '_sum_tt', '_sum_x', '_sum_tx')
+
+  def __init__(self, retention, capacity, fields):
+    self.retention = retention
+    self.capacity = capacity
+    self._cols = {field: i for i, field in enumerate(fields)}
+
+    # Preallocated slots, plain lists are faster than ndarrays for scalar access
+    self._t = [0.0] * capacity
+    self._x = [[0.0] * capacity for _ in fields]
+    self.clear()
+
+  def clear(self):
+    self._head = 0  # index of the oldest sample
+    self._len = 0
+
+    # Sums over times relative to _t0 to keep precision over long drives
+    self._t0 = 0.0
+    self._sum_t = 0.0
+    self._sum_tt = 0.0
+    self._sum_x = [0.0] * len(self._x)
+    self._sum_tx = [0.0] * len(self._x)
+
+  def __len__(self):
+    return self._len
 
-  left_blinker = False
-  right_blinker = False
-  cruise_enabled = True
+  def append(self, t, *values):
+    if self._len == self.capacity:
+      self._pop()
+    if self._len == 0:
+      self._t0 = t
+
+    idx = (self._head + self._len) % self.capacity
+    self._t[idx] = t
+    self._len += 1
+
+    t -= self._t0
+    self._sum_t += t
+    self._sum_tt += t * t
+    for i, x in enumerate(values):
+      self._x[i][idx] = x
+      self._sum_x[i] += x
+      self._sum_tx[i] += t * x
+
+  def expire(self, cur_time):
+    while self._len and cur_time - self._t[self._head] > self.retention:
+      self._pop()
+
+  def oldest(self, field):
+    return self._x[self._cols[field]][self._head]
+
+  def mean(self, field):
+    """Mean of field in the window, 0 without samples"""
+    if self._len == 0:
+      return 0.0
+    return self._sum_x[self._cols[field]] / self._len
+
+  def slope(self, field):
+    """Least squares slope of field over time in the window, 0 with fewer than 2 samples"""
+    col = self._cols[field]
+    denom = self._len * self._sum_tt - self._sum_t ** 2
+    if self._len < 2 or denom < 1e-9:
+      return 0.0
+    return (self._len * self._sum_tx[col] - self._sum_t * self._sum_x[col]) / denom
+
+  def values(self, field):
+    """Array of field ordered oldest to newest, not meant for the hot path"""
+    return np.array(self._ordered(self._x[self._cols[field]]))
+
+  def _ordered(self, slots):
+    end = self._head + self._len
+    if end <= self.capacity:
+      return slots[self._head:end]
+    return slots[self._head:] + slots[:end - self.capacity]
+
+  def _pop(self):
+    head = self._head
+    t = self._t[head] - self._t0
+    self._sum_t -= t
+    self._sum_tt -= t * t
+    for i, col in enumerate(self._x):
+      self._sum_x[i] -= col[head]
+      self._sum_tx[i] -= t * col[head]
+
+    self._head = (head + 1) % self.capacity
+    self._len -= 1
+    if self._head == 0:  # once per lap, drop accumulated rounding error
+      self._resum()
+
+  def _resum(self):
+    t = self._ordered(self._t)
+    self._t0 = t[0] if t else 0.0
+    t = [ti - self._t0 for ti in t]
+    self._sum_t = sum(t)
+    self._sum_tt = sum(ti * ti for ti in t)
+    for i, col in enumerate(self._x):
+      x = self._ordered(col)
+      self._sum_x[i] = sum(x)
+      self._sum_tx[i] = sum(ti * xi for ti, xi in zip(t, x))
 
 
 class dfData:
-  v_egos = []
-  v_rels = []
+  __slots__ = ('v_egos', 'v_rels')
+
+  def __init__(self, v_ego_retention, v_rel_retention, capacity=64):  # 64 > 2.5 s at 20 Hz
+    self.v_egos = TimedRingBuffer(v_ego_retention, capacity, ('v_ego',))
+    self.v_rels = TimedRingBuffer(v_rel_retention, capacity, ('v_ego', 'v_lead'))
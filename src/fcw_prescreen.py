@@ -0,0 +1,180 @@
+from collections import namedtuple
+import math
+
+import numpy as np
+
+# FCWChecker (selfdrive/controls/lib/fcw.py) as of 0.8.5, mirrored below
+MAX_TTC = 5.0  # s
+TTC_DECEL_TIME = 2.  # s
+FCW_TTC = 2.5  # s
+FCW_MIN_A = -3.0  # m/s^2, any planned accel below it
+FCW_A_ACT_V = (-3., -2.)  # m/s^2, planned accel drop in the first 15 samples, vs lead speed
+FCW_A_ACT_BP = (0., 30.)
+# Below it on a tick with an FCW lead, whatever the lead speed, the checker may alert
+FCW_A_THR_MAX = max(FCW_A_ACT_V)
+COUNTER_MIN = 10
+FCW_INTERVAL = 5.0  # s between alerts for a lead
+BLINKER_STEP = 10.0 / (20 * 3.0)
+LEAD_SEEN_STEP = 0.33
+
+FCWBatchResult = namedtuple('FCWBatchResult', ['fcw', 'clearly_safe', 'ttc', 'horizon_ttc', 'required_decel', 'min_gap'])
+
+
+def _steps_to_reach(step, threshold=COUNTER_MIN):
+  """Increments of step until a counter summed like FCWChecker's reaches threshold"""
+  total, n = 0, 0
+  while not total >= threshold:
+    total += step
+    n += 1
+  return n
+
+
+BLINKER_TICKS = _steps_to_reach(BLINKER_STEP)
+LEAD_SEEN_TICKS = _steps_to_reach(LEAD_SEEN_STEP)
+
+
+def calc_ttc(v_ego, a_ego, x_lead, v_lead, a_lead):
+  """FCWChecker.calc_ttc with math instead of NumPy scalars"""
+  v_rel = v_ego - v_lead
+  a_rel = min(a_ego - a_lead, v_lead / TTC_DECEL_TIME)
+  delta = v_rel**2 + 2 * x_lead * a_rel
+  if delta < 0.1 or (math.sqrt(delta) + v_rel < 0.1):
+    return MAX_TTC
+  return min(2 * x_lead / (math.sqrt(delta) + v_rel), MAX_TTC)
+
+
+def calc_ttc_batch(v_ego, a_ego, x_lead, v_lead, a_lead):
+  v_rel = v_ego - v_lead
+  a_rel = np.minimum(a_ego - a_lead, v_lead / TTC_DECEL_TIME)
+  delta = v_rel**2 + 2 * x_lead * a_rel
+  root = np.sqrt(np.maximum(delta, 0.))
+  no_solution = (delta < 0.1) | (root + v_rel < 0.1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    ttc = np.minimum(2 * x_lead / (root + v_rel), MAX_TTC)
+  return np.where(no_solution, MAX_TTC, ttc)
+
+
+def a_threshold_batch(v_lead):
+  """interp(v_lead, FCW_A_ACT_BP, FCW_A_ACT_V) computed like common.numpy_fast.interp"""
+  (bp0, bp1), (v0, v1) = FCW_A_ACT_BP, FCW_A_ACT_V
+  return np.where(v_lead <= bp0, v0, np.where(v_lead > bp1, v1, (v_lead - bp0) * (v1 - v0) / (bp1 - bp0) + v0))
+
+
+def horizon_metrics(solutions):
+  """
+  Over the 21 samples of log_t records, any leading shape: (closest time to collision at the
+  planned speeds in s, largest decel closing the gap needs on top of the lead's in m/s^2, smallest gap in m)
+  """
+  gap = solutions['x_l'] - solutions['x_ego']
+  v_rel = solutions['v_ego'] - solutions['v_l']
+  closing = v_rel > 0.
+  safe_gap = np.maximum(gap, 0.01)
+  with np.errstate(divide='ignore'):
+    ttc = np.where(closing, safe_gap / np.where(closing, v_rel, 1.), np.inf).min(axis=-1)
+  required_decel = np.where(closing, v_rel**2 / (2 * safe_gap), 0.).max(axis=-1)
+  return np.minimum(ttc, MAX_TTC), required_decel, gap.min(axis=-1)
+
+
+class FCWPrescreen:
+  """
+  Skips FCWChecker.update on ticks with an FCW lead that can't raise an FCW, with all of the
+  planned accel above FCW_MIN_A and its drop in the first 15 samples above FCW_A_THR_MAX. Those
+  only advance the checker's counters like it would, so the alerts are the same as calling the
+  checker every tick
+  """
+  __slots__ = ('skips', 'checks')
+
+  def __init__(self):
+    self.skips = 0
+    self.checks = 0
+
+  def update(self, checker, solution, mpc_solution, cur_time, active, v_ego, a_ego, x_lead, v_lead, a_lead,
+             y_lead, vlat_lead, fcw_lead, blinkers):
+    """solution is the zero-copy view of mpc_solution, the rest are FCWChecker.update's arguments"""
+    if fcw_lead > 0.99:
+      min_a_15, min_a = np.minimum.accumulate(solution['a_ego'])[[14, -1]].tolist()
+      if min_a >= FCW_MIN_A and min_a_15 - min(0., a_ego) >= FCW_A_THR_MAX:
+        self.skips += 1
+        self._advance(checker, min_a, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead, blinkers)
+        return False
+      self.checks += 1
+    # Without an FCW lead the checker only updates its common counters, that's cheap already
+    return checker.update(mpc_solution, cur_time, active, v_ego, a_ego, x_lead, v_lead, a_lead,
+                          y_lead, vlat_lead, fcw_lead, blinkers)
+
+  @staticmethod
+  def _advance(checker, min_a, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead, blinkers):
+    """What FCWChecker.update changes on a tick with an FCW lead and no alert"""
+    checker.last_min_a = min_a
+    checker.v_lead_max = max(checker.v_lead_max, v_lead)
+    common = checker.common_counters
+    common['blinkers'] = common['blinkers'] + BLINKER_STEP if not blinkers else 0
+    common['v_ego'] = common['v_ego'] + 1 if v_ego > 5.0 else 0
+    counters = checker.counters
+    counters['ttc'] = counters['ttc'] + 1 if calc_ttc(v_ego, a_ego, x_lead, v_lead, a_lead) < FCW_TTC else 0
+    counters['v_lead_max'] = counters['v_lead_max'] + 1 if checker.v_lead_max > 2.5 else 0
+    counters['v_ego_lead'] = counters['v_ego_lead'] + 1 if v_ego > v_lead else 0
+    counters['lead_seen'] = counters['lead_seen'] + LEAD_SEEN_STEP
+    counters['y_lead'] = counters['y_lead'] + 1 if abs(y_lead) < 1.0 else 0
+    counters['vlat_lead'] = counters['vlat_lead'] + 1 if abs(vlat_lead) < 0.4 else 0
+
+
+def _run_lengths(condition, starts):
+  """Per element, how many elements in a row up to it hold condition, restarting at starts"""
+  idx = np.arange(len(condition))
+  last_break = np.maximum.accumulate(np.where(~condition | starts, idx, -1))
+  # The run includes its break if that's a start that holds
+  held = (last_break >= 0) & condition[np.maximum(last_break, 0)]
+  return np.where(condition, idx - last_break + held, 0)
+
+
+def evaluate_drive(t, solutions, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead, fcw_lead, blinkers, new_lead):
+  """
+  FCWChecker over a drive as the planner runs it, reset_lead on new_lead ticks then update on
+  every tick. Inputs are per tick arrays, solutions log_t records (see libmpc_py.LOG_T_DTYPE).
+  Returns: FCWBatchResult of per tick arrays, fcw as the checker would return it
+  """
+  t, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead = (
+    np.asarray(x, dtype=np.float64) for x in (t, v_ego, a_ego, x_lead, v_lead, a_lead, y_lead, vlat_lead))
+  fcw_lead = np.asarray(fcw_lead, dtype=np.float64) > 0.99
+  blinkers = np.asarray(blinkers, dtype=bool)
+  new_lead = np.asarray(new_lead, dtype=bool)
+  n = len(t)
+
+  a = solutions['a_ego']
+  min_a = a.min(axis=-1)
+  min_a_15 = a[:, :15].min(axis=-1)
+  a_delta = min_a_15 - np.minimum(0., a_ego)
+  clearly_safe = ~fcw_lead | ((min_a >= FCW_MIN_A) & (a_delta >= FCW_A_THR_MAX))
+  ttc = calc_ttc_batch(v_ego, a_ego, x_lead, v_lead, a_lead)
+  horizon_ttc, required_decel, min_gap = horizon_metrics(solutions)
+
+  # Lead segments start at reset_lead, the counters only move on FCW lead ticks
+  segment = np.cumsum(new_lead)
+  v_lead_max = np.maximum(v_lead, 0.)
+  for s in np.split(np.arange(n), np.flatnonzero(new_lead)):
+    v_lead_max[s] = np.maximum.accumulate(v_lead_max[s])
+  lead_idx = np.flatnonzero(fcw_lead)
+  seg = segment[lead_idx]
+  seg_start = np.r_[True, seg[1:] != seg[:-1]] if len(lead_idx) else np.zeros(0, dtype=bool)
+  lead_ok = np.ones(len(lead_idx), dtype=bool)
+  for condition in (ttc[lead_idx] < FCW_TTC, v_lead_max[lead_idx] > 2.5, v_ego[lead_idx] > v_lead[lead_idx],
+                    np.abs(y_lead[lead_idx]) < 1.0, np.abs(vlat_lead[lead_idx]) < 0.4):
+    lead_ok &= _run_lengths(condition, seg_start) >= COUNTER_MIN
+  lead_ok &= _run_lengths(np.ones(len(lead_idx), dtype=bool), seg_start) >= LEAD_SEEN_TICKS
+  no_starts = np.zeros(n, dtype=bool)
+  common_ok = (_run_lengths(~blinkers, no_starts) >= BLINKER_TICKS) & (_run_lengths(v_ego > 5.0, no_starts) >= COUNTER_MIN)
+
+  decel = (min_a < FCW_MIN_A) | (a_delta < a_threshold_batch(v_lead))
+  candidates = lead_idx[lead_ok & common_ok[lead_idx] & decel[lead_idx]]
+
+  # The alert interval is the only state left, few ticks get here
+  fcw = np.zeros(n, dtype=bool)
+  last_fcw_time, last_segment = 0.0, None
+  for i in candidates.tolist():
+    if segment[i] != last_segment:
+      last_fcw_time, last_segment = 0.0, segment[i]
+    if last_fcw_time + FCW_INTERVAL < t[i]:
+      last_fcw_time = t[i]
+      fcw[i] = True
+  return FCWBatchResult(fcw, clearly_safe, ttc, horizon_ttc, required_decel, min_gap)
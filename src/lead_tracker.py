@@ -0,0 +1,47 @@
+class LeadTracker:
+  """
+  Tells whether this tick's radar lead is the one already followed. The previous lead is predicted
+  forward by constant acceleration relative to ego, and the lead is the same one if its distance and
+  speed are within a gate of the prediction. Distance noise grows with range, so a far lead jittering
+  by a few meters stays associated. A lead lost for at most COAST_TIME is predicted through the gap.
+  """
+  __slots__ = ('t', 'x', 'v', 'a', 'v_ego', 'lost_t')
+
+  SIGMA_X = 1.0  # m
+  SIGMA_X_PER_M = 0.03  # of range
+  SIGMA_V = 1.5  # m/s
+  GATE = 13.8  # squared normalized innovation, chi-square with 2 dof at 99.9%
+  COAST_TIME = 0.2  # s
+
+  def __init__(self):
+    self.t = None  # of the last associated lead, None without one
+    self.x = 0.
+    self.v = 0.
+    self.a = 0.
+    self.v_ego = 0.
+    self.lost_t = None
+
+  def innovation(self, t, x_lead, v_lead, v_ego):
+    """Squared normalized distance of the lead from the prediction, None without a lead to predict"""
+    if self.t is None:
+      return None
+    dt = t - self.t
+    v_pred = self.v + self.a * dt
+    x_pred = self.x + (self.v + 0.5 * self.a * dt - 0.5 * (self.v_ego + v_ego)) * dt
+    sigma_x = self.SIGMA_X + self.SIGMA_X_PER_M * max(x_pred, 0.)
+    return ((x_lead - x_pred) / sigma_x) ** 2 + ((v_lead - v_pred) / self.SIGMA_V) ** 2
+
+  def update(self, t, x_lead, v_lead, a_lead, v_ego):
+    """
+    Returns: True if it's the lead already followed
+    """
+    if self.lost_t is not None and t - self.lost_t > self.COAST_TIME:
+      self.t = None
+    d2 = self.innovation(t, x_lead, v_lead, v_ego)
+    self.t, self.x, self.v, self.a, self.v_ego = t, x_lead, v_lead, a_lead, v_ego
+    self.lost_t = None
+    return d2 is not None and d2 <= self.GATE
+
+  def lost(self, t):
+    if self.lost_t is None:
+      self.lost_t = t
@@ -1,5 +1,8 @@
+from collections import namedtuple
 import os
-import math
+import time
+
+import numpy as np
 
 import cereal.messaging as messaging
 from selfdrive.swaglog import cloudlog
@@ -8,13 +11,61 @@ from selfdrive.controls.lib.radar_helpers import _LEAD_ACCEL_TAU
 from selfdrive.controls.lib.longitudinal_mpc import libmpc_py
 from selfdrive.controls.lib.drive_helpers import MPC_COST_LONG
 from selfdrive.controls.lib.dynamic_follow import DynamicFollow
+from selfdrive.controls.lib.lead_tracker import LeadTracker
+from selfdrive.controls.lib.planner_stats import stats
 
 LOG_MPC = os.environ.get('LOG_MPC', False)
+# With LOG_MPC, publish every Nth tick, 0 for only ticks with a new lead or solver reset. Those are always published
+LOG_MPC_EVERY = int(os.environ.get('LOG_MPC_EVERY', 1))
+
+# Resets warm start from the last good solution if it's at most this old, else cold init
+WARM_START_MAX_AGE = 1.0  # s
+
+# Solver backend, see libmpc_py.BACKENDS. numpy runs where the ACADO .so can't load
+MPC_BACKEND = os.environ.get('MPC_BACKEND', libmpc_py.ACADO)
+
+# Without a lead, reuse the last solve while start speed, start accel and TR stay within these
+NO_LEAD_TOLERANCE = (0.1, 0.05, 0.01)  # m/s, m/s^2, s
+
+
+# A finished solve as the planner reads it, so it can keep planning from it while a later solve overruns
+MpcPlan = namedtuple('MpcPlan', ['t', 'prev_lead_status', 'v_mpc', 'a_mpc', 'v_mpc_future', 'solution'])
+
+
+def shift_plan(plan, t):
+  """
+  The plan of an earlier solve advanced along its trajectory to t, or one that defers to cruise
+  if there was no lead or it's too old to follow, like a warm start
+  """
+  if plan is None or not plan.prev_lead_status or t - plan.t > WARM_START_MAX_AGE:
+    return MpcPlan(t, False, float('inf'), 0.0, float('inf'), None)
+  sol = plan.solution
+  v_mpc, v_mpc_future = np.interp([sol['t'][1] + t - plan.t, sol['t'][10] + t - plan.t], sol['t'], sol['v_ego'])
+  a_mpc = np.interp(sol['t'][1] + t - plan.t, sol['t'], sol['a_ego'])
+  return plan._replace(v_mpc=float(v_mpc), a_mpc=float(a_mpc), v_mpc_future=float(v_mpc_future))
+
+
+def check_solution(solution):
+  """
+  Fused sanity check over a NumPy view of log_t
+  Returns: (backwards, crashing, nans, index of the first bad sample or -1)
+  """
+  v_ego = solution['v_ego']
+  crashing = (solution['x_l'] - solution['x_ego']) < -50
+  nans = np.isnan(v_ego)
+  backwards = v_ego < -0.01
+  bad = crashing | nans | backwards
+  first_bad = int(bad.argmax()) if bad.any() else -1
+  return bool(backwards.any()), bool(crashing.any()), bool(nans.any()), first_bad
 
 
 class LongitudinalMpc():
-  def __init__(self, mpc_id):
+  def __init__(self, mpc_id, no_lead_cache=False, no_lead_tolerance=NO_LEAD_TOLERANCE, backend=None, lead_tracking=False):
     self.mpc_id = mpc_id
+    self.lead_tracking = lead_tracking
+    self.backend = backend or MPC_BACKEND
+    self.no_lead_cache = no_lead_cache
+    self.no_lead_tolerance = no_lead_tolerance
 
     self.dynamic_follow = DynamicFollow(mpc_id)
     self.setup_mpc()
@@ -25,44 +76,145 @@ class LongitudinalMpc():
     self.prev_lead_status = False
     self.prev_lead_x = 0.0
     self.new_lead = False
+    self.new_leads = 0  # reinitializations for a new lead
+    # The tracker always runs so both counts are there without lead_tracking, which makes it decide new leads
+    self.lead_tracker = LeadTracker()
+    self.lead_changes = 0  # new leads by the tracker
+    self.spurious_new_leads = 0  # distance jumps the tracker associates with the same lead
+    self.solver_reset = False  # during the last update
+    self.publish_ticks = 0
 
     self.last_cloudlog_t = 0.0
     self.n_its = 0
     self.duration = 0
 
+    self.no_lead_inputs = None  # (v_start, a_start, v_ego, TR) of the cached no lead solve
+    self.no_lead_solution = None  # (v_mpc, a_mpc, v_mpc_future) of that solve
+    self.no_lead_hits = 0
+    self.no_lead_misses = 0
+
+    self.last_good_t = None  # when warm_solution was solved
+    self.warm_resets = 0
+    self.cold_resets = 0
+    # n_its totals on ticks without and with a dynamic follow cost change
+    self.n_its_sum = [0, 0]
+    self.n_its_count = [0, 0]
+
+    self.update_time = stats.histogram(f'mpc{mpc_id}.update')
+    self.solve_time = stats.histogram(f'mpc{mpc_id}.solve')
+
   def publish(self, pm):
-    if LOG_MPC:
-      qp_iterations = max(0, self.n_its)
-      dat = messaging.new_message('liveLongitudinalMpc')
-      dat.liveLongitudinalMpc.xEgo = list(self.mpc_solution[0].x_ego)
-      dat.liveLongitudinalMpc.vEgo = list(self.mpc_solution[0].v_ego)
-      dat.liveLongitudinalMpc.aEgo = list(self.mpc_solution[0].a_ego)
-      dat.liveLongitudinalMpc.xLead = list(self.mpc_solution[0].x_l)
-      dat.liveLongitudinalMpc.vLead = list(self.mpc_solution[0].v_l)
-      dat.liveLongitudinalMpc.cost = self.mpc_solution[0].cost
-      dat.liveLongitudinalMpc.aLeadTau = self.a_lead_tau
-      dat.liveLongitudinalMpc.qpIterations = qp_iterations
-      dat.liveLongitudinalMpc.mpcId = self.mpc_id
-      dat.liveLongitudinalMpc.calculationTime = self.duration
-      pm.send('liveLongitudinalMpc', dat)
+    if not LOG_MPC:
+      return
+    self.publish_ticks += 1
+    if not (self.new_lead or self.solver_reset or (LOG_MPC_EVERY and self.publish_ticks % LOG_MPC_EVERY == 0)):
+      return
+
+    # The front buffer, the next solve writes the other one
+    front = self.front
+    x_ego, v_ego, a_ego, x_l, v_l = self.published_fields[front]
+    dat = messaging.new_message('liveLongitudinalMpc')
+    mpc = dat.liveLongitudinalMpc
+    mpc.xEgo = x_ego.tolist()
+    mpc.vEgo = v_ego.tolist()
+    mpc.aEgo = a_ego.tolist()
+    mpc.xLead = x_l.tolist()
+    mpc.vLead = v_l.tolist()
+    mpc.cost = float(self.solution_views[front]['cost'])
+    mpc.aLeadTau = self.a_lead_tau
+    mpc.qpIterations = max(0, self.n_its)
+    mpc.mpcId = self.mpc_id
+    mpc.calculationTime = self.duration
+    pm.send('liveLongitudinalMpc', dat)
 
   def setup_mpc(self):
-    ffi, self.libmpc = libmpc_py.get_libmpc(self.mpc_id)
+    self.ffi, self.libmpc = libmpc_py.get_libmpc(self.mpc_id, self.backend)
+    ffi = self.ffi
+    # The prebuilt libmpc<id>.so don't export init_with_solution, resets are cold with them
+    self.warm_start = hasattr(self.libmpc, 'init_with_solution')
     self.libmpc.init(MPC_COST_LONG.TTC, MPC_COST_LONG.DISTANCE,
                      MPC_COST_LONG.ACCELERATION, MPC_COST_LONG.JERK)
 
-    self.mpc_solution = ffi.new("log_t *")
+    # Solves alternate between two buffers, mpc_solution is the last finished one
+    self.solutions = [ffi.new("log_t *"), ffi.new("log_t *")]
+    self.solution_views = [libmpc_py.solution_view(ffi, solution) for solution in self.solutions]
+    self.published_fields = [[view[field] for field in ('x_ego', 'v_ego', 'a_ego', 'x_l', 'v_l')] for view in self.solution_views]
+    self.front = 0
+    self.mpc_solution = self.solutions[0]
+    self.solution_view = self.solution_views[0]
+    self.warm_solution = ffi.new("log_t *")
+    self.warm_view = libmpc_py.solution_view(ffi, self.warm_solution)
     self.cur_state = ffi.new("state_t *")
     self.cur_state[0].v_ego = 0
     self.cur_state[0].a_ego = 0
     self.a_lead_tau = _LEAD_ACCEL_TAU
 
+  def plan(self, t):
+    return MpcPlan(t, self.prev_lead_status, self.v_mpc, self.a_mpc, self.v_mpc_future, self.solution_view.copy())
+
+  def resync(self, t):
+    """Catches up after a solve that overran, restarting from the last good trajectory like a reset"""
+    self._restart_solver(t)
+    self.no_lead_inputs = None
+
   def set_cur_state(self, v, a):
     self.cur_state[0].v_ego = v
     self.cur_state[0].a_ego = a
 
+  def _reuse_no_lead_solution(self, v_ego, TR):
+    """
+    Extrapolates the cached no lead solution to the current start speed when inputs are close enough
+    Returns: True if the solve can be skipped
+    """
+    cur = self.cur_state[0]
+    cached = self.no_lead_inputs
+    v_tol, a_tol, TR_tol = self.no_lead_tolerance
+    if (cached is None or abs(cur.v_ego - cached[0]) > v_tol or abs(cur.a_ego - cached[1]) > a_tol or
+        abs(v_ego - cached[2]) > v_tol or abs(TR - cached[3]) > TR_tol):
+      self.no_lead_misses += 1
+      return False
+
+    dv = cur.v_ego - cached[0]
+    v_mpc, a_mpc, v_mpc_future = self.no_lead_solution
+    self.v_mpc = v_mpc + dv
+    self.a_mpc = a_mpc
+    self.v_mpc_future = v_mpc_future + dv
+    self.n_its = 0
+    self.no_lead_hits += 1
+    return True
+
+  def _restart_solver(self, t):
+    """
+    Restarts the solver from the last good trajectory shifted to now, or cold without a recent one
+    Returns: True if warm
+    """
+    if not self.warm_start or self.last_good_t is None or t - self.last_good_t > WARM_START_MAX_AGE:
+      self.libmpc.init(MPC_COST_LONG.TTC, MPC_COST_LONG.DISTANCE,
+                       MPC_COST_LONG.ACCELERATION, MPC_COST_LONG.JERK)
+      self.dynamic_follow.last_cost = 0.0  # init reset the distance cost, push it again
+      return False
+
+    warm = self.warm_view
+    t_grid = warm['t'].copy()
+    t_shifted = t_grid + (t - self.last_good_t)
+    for field in ('x_ego', 'v_ego', 'a_ego'):
+      warm[field] = np.interp(t_shifted, t_grid, warm[field])
+    warm['j_ego'] = np.interp(t_shifted[:-1], t_grid[:-1], warm['j_ego'])
+    warm['x_ego'] -= warm['x_ego'][0]
+    self.libmpc.init_with_solution(self.warm_solution)
+    self.last_good_t = None  # don't shift the same trajectory twice
+    return True
+
   def update(self, CS, lead, TR_override):
+    start = time.monotonic_ns()
+    self._update(CS, lead, TR_override)
+    self.update_time.add(time.monotonic_ns() - start)
+
+  def _update(self, CS, lead, TR_override):
     v_ego = CS.vEgo
+    now = sec_since_boot()
+    restarted = self.solver_reset
+    self.solver_reset = False
 
     # Setup current mpc state
     self.cur_state[0].x_ego = 0.0
@@ -77,10 +229,17 @@ class LongitudinalMpc():
         a_lead = 0.0
 
       self.a_lead_tau = lead.aLeadTau
-      self.new_lead = False
-      if not self.prev_lead_status or abs(x_lead - self.prev_lead_x) > 2.5:
+      same_lead = self.lead_tracker.update(now, x_lead, v_lead, a_lead, v_ego)
+      distance_jump = not self.prev_lead_status or abs(x_lead - self.prev_lead_x) > 2.5
+      self.lead_changes += not same_lead
+      # A solver reset clears prev_lead_status to resimulate, that's no radar jump
+      self.spurious_new_leads += distance_jump and same_lead and not restarted
+      self.new_lead = (not same_lead) if self.lead_tracking else distance_jump
+      # The solver still needs the lead simulated in after solving without one
+      if self.new_lead or not self.prev_lead_status:
         self.libmpc.init_with_simulation(self.v_mpc, x_lead, v_lead, a_lead, self.a_lead_tau)
-        self.new_lead = True
+      if self.new_lead:
+        self.new_leads += 1
 
       self.dynamic_follow.update_lead(v_lead, a_lead, x_lead, lead.status, self.new_lead)
       self.prev_lead_status = True
@@ -88,7 +247,9 @@ class LongitudinalMpc():
       self.cur_state[0].x_l = x_lead
       self.cur_state[0].v_l = v_lead
     else:
+      self.lead_tracker.lost(now)
       self.dynamic_follow.update_lead(new_lead=self.new_lead)
+      self.new_lead = False  # only the tick a lead appeared is new, publish keys off it
       self.prev_lead_status = False
       # Fake a fast lead car, so mpc keeps running
       self.cur_state[0].x_l = 50.0
@@ -103,8 +264,21 @@ class LongitudinalMpc():
 
     # Calculate mpc
     t = sec_since_boot()
-    self.n_its = self.libmpc.run_mpc(self.cur_state, self.mpc_solution, self.a_lead_tau, a_lead, TR)
+    if self.no_lead_cache and not self.prev_lead_status and self._reuse_no_lead_solution(v_ego, TR):
+      self.duration = int((sec_since_boot() - t) * 1e9)
+      return
+
+    back = 1 - self.front
+    self.n_its = self.libmpc.run_mpc(self.cur_state, self.solutions[back], self.a_lead_tau, a_lead, TR)
+    self.front = back
+    self.mpc_solution = self.solutions[back]
+    self.solution_view = self.solution_views[back]
     self.duration = int((sec_since_boot() - t) * 1e9)
+    self.solve_time.add(self.duration)
+
+    cost_changed = int(not TR_override and self.dynamic_follow.cost_changed)
+    self.n_its_sum[cost_changed] += self.n_its
+    self.n_its_count[cost_changed] += 1
 
     # Get solution. MPC timestep is 0.2 s, so interpolation to 0.05 s is needed
     self.v_mpc = self.mpc_solution[0].v_ego[1]
@@ -112,20 +286,34 @@ class LongitudinalMpc():
     self.v_mpc_future = self.mpc_solution[0].v_ego[10]
 
     # Reset if NaN or goes through lead car
-    crashing = any(lead - ego < -50 for (lead, ego) in zip(self.mpc_solution[0].x_l, self.mpc_solution[0].x_ego))
-    nans = any(math.isnan(x) for x in self.mpc_solution[0].v_ego)
-    backwards = min(self.mpc_solution[0].v_ego) < -0.01
+    backwards, crashing, nans, first_bad = check_solution(self.solution_view)
 
     if ((backwards or crashing) and self.prev_lead_status) or nans:
       if t > self.last_cloudlog_t + 5.0:
         self.last_cloudlog_t = t
-        cloudlog.warning("Longitudinal mpc %d reset - backwards: %s crashing: %s nan: %s" % (
-                          self.mpc_id, backwards, crashing, nans))
+        cloudlog.warning("Longitudinal mpc %d reset - backwards: %s crashing: %s nan: %s first bad: %d" % (
+                          self.mpc_id, backwards, crashing, nans, first_bad))
 
-      self.libmpc.init(MPC_COST_LONG.TTC, MPC_COST_LONG.DISTANCE,
-                       MPC_COST_LONG.ACCELERATION, MPC_COST_LONG.JERK)
+      if self._restart_solver(t):
+        self.warm_resets += 1
+      else:
+        self.cold_resets += 1
+      self.solver_reset = True
       self.cur_state[0].v_ego = v_ego
       self.cur_state[0].a_ego = 0.0
       self.v_mpc = v_ego
       self.a_mpc = CS.aEgo
       self.prev_lead_status = False
+      self.no_lead_inputs = None
+      return
+
+    if first_bad < 0 and self.warm_start:
+      self.ffi.memmove(self.warm_solution, self.mpc_solution, self.ffi.sizeof("log_t"))
+      self.last_good_t = t
+
+    if self.no_lead_cache:
+      if self.prev_lead_status:
+        self.no_lead_inputs = None
+      else:
+        self.no_lead_inputs = (self.cur_state[0].v_ego, self.cur_state[0].a_ego, v_ego, TR)
+        self.no_lead_solution = (self.v_mpc, self.a_mpc, self.v_mpc_future)
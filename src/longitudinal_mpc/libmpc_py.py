@@ -1,42 +1,102 @@
 import os
 
+import numpy as np
 from cffi import FFI
 from common.ffi_wrapper import suffix
 
-mpc_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+mpc_dir = os.environ.get('LIBMPC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__))))
 
-def _get_libmpc(mpc_id):
-    libmpc_fn = os.path.join(mpc_dir, "libmpc%d%s" % (mpc_id, suffix()))
+CDEF = """
+typedef struct {
+double x_ego, v_ego, a_ego, x_l, v_l, a_l;
+} state_t;
 
-    ffi = FFI()
-    ffi.cdef("""
-    typedef struct {
-    double x_ego, v_ego, a_ego, x_l, v_l, a_l;
-    } state_t;
 
+typedef struct {
+double x_ego[21];
+double v_ego[21];
+double a_ego[21];
+double j_ego[20];
+double x_l[21];
+double v_l[21];
+double a_l[21];
+double t[21];
+double cost;
+} log_t;
 
-    typedef struct {
-    double x_ego[21];
-    double v_ego[21];
-    double a_ego[21];
-    double j_ego[20];
-    double x_l[21];
-    double v_l[21];
-    double a_l[21];
-    double t[21];
-    double cost;
-    } log_t;
+void init(double ttcCost, double distanceCost, double accelerationCost, double jerkCost);
+void init_with_simulation(double v_ego, double x_l, double v_l, double a_l, double l);
+void change_costs(double ttcCost, double distanceCost, double accelerationCost, double jerkCost);
+void init_with_solution(log_t * solution);
+int run_mpc(state_t * x0, log_t * solution,
+            double l, double a_l_0, double TR);
+"""
 
-    void init(double ttcCost, double distanceCost, double accelerationCost, double jerkCost);
-    void init_with_simulation(double v_ego, double x_l, double v_l, double a_l, double l);
-    void change_costs(double ttcCost, double distanceCost, double accelerationCost, double jerkCost);
-    int run_mpc(state_t * x0, log_t * solution,
-                double l, double a_l_0, double TR);
-    """)
+# Mirrors log_t above so a solution can be read as NumPy arrays without
+# crossing the cffi boundary per element.
+N = 20
+LOG_T_DTYPE = np.dtype([
+    ('x_ego', np.float64, N + 1),
+    ('v_ego', np.float64, N + 1),
+    ('a_ego', np.float64, N + 1),
+    ('j_ego', np.float64, N),
+    ('x_l', np.float64, N + 1),
+    ('v_l', np.float64, N + 1),
+    ('a_l', np.float64, N + 1),
+    ('t', np.float64, N + 1),
+    ('cost', np.float64),
+])
 
-    return (ffi, ffi.dlopen(libmpc_fn))
+# Solver backends with the interface in CDEF: the generated ACADO solver in libmpc<id>.so,
+# or the reference solver in numpy_mpc.py that also runs where the .so can't load
+ACADO = 'acado'
+NUMPY = 'numpy'
+BACKENDS = (ACADO, NUMPY)
 
-mpcs = [_get_libmpc(1), _get_libmpc(2)]
+# Parsed and loaded on first use, so importing this module is cheap
+_ffi = None
+_libmpcs = {}
+_libmpc_factory = None
 
-def get_libmpc(mpc_id):
-    return mpcs[mpc_id - 1]
+def get_ffi():
+    global _ffi
+    if _ffi is None:
+        _ffi = FFI()
+        _ffi.cdef(CDEF)
+    return _ffi
+
+def set_libmpc_dir(path):
+    """Load libmpc<id> from path, only affects solvers not loaded yet."""
+    global mpc_dir
+    mpc_dir = path
+
+def set_libmpc_factory(factory):
+    """
+    Use factory(ffi, mpc_id) instead of dlopen for the ACADO backend. It must return
+    an object with the functions declared in CDEF, taking the cffi types above.
+    """
+    global _libmpc_factory
+    _libmpc_factory = factory
+    _libmpcs.clear()
+
+def _load_libmpc(mpc_id, backend):
+    ffi = get_ffi()
+    if backend == NUMPY:
+        from selfdrive.controls.lib.longitudinal_mpc.numpy_mpc import NumpyLibmpc
+        return NumpyLibmpc(ffi, mpc_id)
+    if backend != ACADO:
+        raise ValueError("Unknown mpc backend %s" % backend)
+    if _libmpc_factory is not None:
+        return _libmpc_factory(ffi, mpc_id)
+    return ffi.dlopen(os.path.join(mpc_dir, "libmpc%d%s" % (mpc_id, suffix())))
+
+def get_libmpc(mpc_id, backend=ACADO):
+    """One solver per id and backend, like the ACADO globals in each .so"""
+    key = (backend, mpc_id)
+    if key not in _libmpcs:
+        _libmpcs[key] = _load_libmpc(mpc_id, backend)
+    return (get_ffi(), _libmpcs[key])
+
+def solution_view(ffi, solution):
+    """Zero-copy structured view of a cffi `log_t *`."""
+    return np.frombuffer(ffi.buffer(solution), dtype=LOG_T_DTYPE)[0]
@@ -131,6 +131,23 @@ void init_with_simulation(double v_ego, double x_l_0, double v_l_0, double a_l_0
   for (i = 0; i < NYN; ++i)  acadoVariables.yN[ i ] = 0.0;
 }
 
+void init_with_solution(log_t * solution){
+  int i;
+
+  // Like init, but keeps the current weights and starts from a previous trajectory
+  acado_initializeSolver();
+
+  for (i = 0; i < N + 1; ++i){
+    acadoVariables.x[i*NX] = solution->x_ego[i];
+    acadoVariables.x[i*NX+1] = solution->v_ego[i];
+    acadoVariables.x[i*NX+2] = solution->a_ego[i];
+  }
+
+  for (i = 0; i < N; ++i)  acadoVariables.u[ i ] = solution->j_ego[i];
+  for (i = 0; i < NY * N; ++i)  acadoVariables.y[ i ] = 0.0;
+  for (i = 0; i < NYN; ++i)  acadoVariables.yN[ i ] = 0.0;
+}
+
 int run_mpc(state_t * x0, log_t * solution, double l, double a_l_0, double TR){
   // Calculate lead vehicle predictions
   int i;
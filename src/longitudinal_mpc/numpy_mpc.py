@@ -0,0 +1,267 @@
+"""
+Reference longitudinal MPC in NumPy, with the libmpc interface declared in libmpc_py.
+
+Same model and objective as the ACADO solver: ego states x_ego, v_ego, a_ego driven by
+jerk over the 21 node horizon, least squares residuals for time to collision, distance,
+acceleration and jerk, v_ego >= 0. The dynamics are linear, so states are condensed into
+a function of the 20 jerks and each Gauss-Newton step is one dense 20x20 solve. Steps
+that violate the v_ego bound are solved again with the violated nodes as equality
+constraints, dropping the ones whose multiplier turns negative.
+
+run_mpc does one step from the previous solution like ACADO's real time iteration,
+solve_batch solves many independent problems at once along a leading batch axis.
+"""
+import numpy as np
+
+from selfdrive.controls.lib.longitudinal_mpc.libmpc_py import LOG_T_DTYPE, N, solution_view
+
+# 0.2 s for the first 5 intervals, 0.6 s after, as in longitudinal_mpc.c
+DT = np.array([0.2] * 5 + [0.6] * (N - 5))
+T = np.concatenate([[0.], np.cumsum(DT)])
+STEP_MULTIPLIER = np.where(np.arange(N) > 4, 3., 1.)
+
+MAX_QP_ITERATIONS = 10
+REGULARIZATION = 1e-8
+MAX_TTC_EXPONENT = 20.  # keeps the exponential time to collision cost finite when far inside the lead
+
+
+def _condensed_dynamics():
+  """
+  Exact discretization of the jerk driven triple integrator over the grid
+  Returns: (phi (N+1, 3, 3), g (N+1, 3, N)), states are phi @ x0 + g @ u
+  """
+  phi = np.zeros((N + 1, 3, 3))
+  g = np.zeros((N + 1, 3, N))
+  phi[0] = np.eye(3)
+  for i, dt in enumerate(DT):
+    a = np.array([[1., dt, dt**2 / 2], [0., 1., dt], [0., 0., 1.]])
+    b = np.array([dt**3 / 6, dt**2 / 2, dt])
+    phi[i + 1] = a @ phi[i]
+    g[i + 1] = a @ g[i]
+    g[i + 1, :, i] += b
+  return phi, g
+
+
+PHI, G = _condensed_dynamics()
+
+
+def predict_lead(x_l, v_l, a_l_0, l):
+  """
+  Lead trajectory of run_mpc in longitudinal_mpc.c, over a batch. With v_l >= 0, as LongitudinalMpc
+  passes it, speed only clamps at 0 while braking and then stays there, so cumulative sums match the recurrence
+  """
+  x_l, v_l, a_l_0, l = (np.asarray(v, dtype=np.float64)[..., None] for v in (x_l, v_l, a_l_0, l))
+  a_l = a_l_0 * np.exp(-l * T[:-1]**2 / 2)
+  v_next = v_l + np.cumsum(a_l * DT, axis=-1)
+  stopped = v_next < 0.
+  v_l, a_l_0 = np.broadcast_arrays(v_l, a_l_0)
+  vs = np.concatenate([v_l, np.where(stopped, 0., v_next)], axis=-1)
+  accels = np.concatenate([a_l_0, np.where(stopped, 0., a_l)], axis=-1)
+  xs = x_l + np.concatenate([np.zeros(vs.shape[:-1] + (1,)), np.cumsum(vs[..., :-1] * DT, axis=-1)], axis=-1)
+  return xs, vs, accels
+
+
+def _residuals(x_ego, v_ego, a_ego, j_ego, x_l, v_l, TR):
+  """
+  Residuals of every node and their derivatives by x_ego, v_ego, a_ego and j_ego, as the
+  generated acado_evaluateLSQ. Inputs are (..., N+1), j_ego is 0 on the end node
+  Returns: (r (..., N+1, 4), dr (..., N+1, 4, 4))
+  """
+  TR = TR[..., None]
+  d = x_l - x_ego
+  rw = v_ego * TR - (v_l - v_ego) * TR + (v_ego * v_ego - v_l * v_l) / 19.62
+  drw = 2 * TR + v_ego / 9.81
+  sqrt_v = np.sqrt(np.maximum(v_ego, 0.) + 0.5)  # only differs from ACADO on linearization points going backwards
+  s = sqrt_v + 0.1
+  norm_rw = (rw + 4. - d) / s
+  e = np.exp(np.minimum(0.3 * norm_rw, MAX_TTC_EXPONENT))
+  q = 0.05 * v_ego + 0.5
+  k = 0.1 * v_ego + 1.
+
+  r = np.stack([e - 1., (d - 4. - rw) / q, a_ego * k, j_ego * k], axis=-1)
+  dr = np.zeros(r.shape + (4,))
+  dr[..., 0, 0] = 0.3 * e / s
+  dr[..., 0, 1] = 0.3 * e * (drw / s - (rw + 4. - d) * 0.5 / sqrt_v / (s * s))
+  dr[..., 1, 0] = -1. / q
+  dr[..., 1, 1] = -drw / q - (d - 4. - rw) * 0.05 / (q * q)
+  dr[..., 2, 1] = 0.1 * a_ego
+  dr[..., 2, 2] = k
+  dr[..., 3, 1] = 0.1 * j_ego
+  dr[..., 3, 3] = k
+  return r, dr
+
+
+def node_weights(costs):
+  """(..., 4) ttc, distance, acceleration and jerk costs to (..., N+1, 4) weights per node like init in longitudinal_mpc.c"""
+  costs = np.asarray(costs, dtype=np.float64)[..., None, :]
+  w = np.concatenate([np.broadcast_to(STEP_MULTIPLIER[:, None], (N, 4)), np.full((1, 4), 3.)]) * costs
+  w[..., N, 3] = 0.  # no jerk on the end node
+  return w
+
+
+def _states(x0, u):
+  return (PHI @ x0[..., None, :, None] + G @ u[..., None, :, None])[..., 0]
+
+
+def stopping_rollout(x0):
+  """States holding the current accel until stopped, the batch linearization point"""
+  x_ego, v_ego, a_ego = x0[..., 0, None], x0[..., 1, None], x0[..., 2, None]
+  t_stop = np.where(a_ego < 0., -v_ego / np.where(a_ego < 0., a_ego, -1.), np.inf)
+  t = np.minimum(T, t_stop)
+  states = np.stack([x_ego + v_ego * t + a_ego * t * t / 2, v_ego + a_ego * t, np.where(T < t_stop, a_ego, 0.)], axis=-1)
+  states[..., 1] = np.maximum(states[..., 1], 0.)
+  return states
+
+
+def objective(states, u, x_l, v_l, TR, weights):
+  j_ego = np.concatenate([u, np.zeros(u.shape[:-1] + (1,))], axis=-1)
+  r, _ = _residuals(states[..., 0], states[..., 1], states[..., 2], j_ego, x_l, v_l, TR)
+  return 0.5 * np.sum(weights * r * r, axis=(-2, -1))
+
+
+def gauss_newton_step(x0, states_lin, u_lin, x_l, v_l, TR, weights):
+  """
+  One Gauss-Newton step from the linearization point, batched over leading axes
+  Returns: (u, states, QP iterations)
+  """
+  batch = x0.shape[:-1]
+  j_lin = np.concatenate([u_lin, np.zeros(batch + (1,))], axis=-1)
+  r, dr = _residuals(states_lin[..., 0], states_lin[..., 1], states_lin[..., 2], j_lin, x_l, v_l, TR)
+
+  # Residuals as an affine function of u: r(u) = c + A u
+  A = dr[..., :3] @ G
+  A[..., :N, 3, :] += dr[..., :N, 3, 3, None] * np.eye(N)
+  free = _states(x0, np.zeros(batch + (N,)))
+  c = r + (dr[..., :3] @ (free - states_lin)[..., None])[..., 0] - dr[..., 3] * j_lin[..., None]
+
+  A = A.reshape(batch + ((N + 1) * 4, N))
+  c = c.reshape(batch + ((N + 1) * 4,))
+  w = weights.reshape(weights.shape[:-2] + ((N + 1) * 4,))
+  wA_T = np.swapaxes(w[..., None] * A, -1, -2)
+  H = wA_T @ A + REGULARIZATION * np.eye(N)
+  grad = (wA_T @ c[..., None])[..., 0]
+  u = np.linalg.solve(H, -grad[..., None])[..., 0]
+
+  # v_ego >= 0 on nodes 1..N
+  g_v = G[1:, 1]
+  v_free = free[..., 1:, 1]
+  active = (v_free + u @ g_v.T) < -1e-6
+  iterations = np.ones(batch, dtype=np.int64)
+  if active.any():
+    u, iterations = _constrained(H, grad, g_v, v_free.reshape(-1, N), u.reshape(-1, N), active.reshape(-1, N))
+    u, iterations = u.reshape(batch + (N,)), iterations.reshape(batch)
+  return u, _states(x0, u), iterations
+
+
+def _constrained(H, grad, g_v, v_free, u, active):
+  """
+  Active set solves for the flattened problems whose unconstrained step violates v_ego >= 0. The KKT
+  system is [[H, -g_v^T], [g_v, 0]] [u, multipliers] = [-grad, -v_free] over the active nodes, inactive
+  nodes get identity rows so their multipliers are 0 and the size stays fixed for batching
+  """
+  H, grad = H.reshape(-1, N, N), grad.reshape(-1, N)
+  iterations = np.ones(len(u), dtype=np.int64)
+  todo = np.flatnonzero(active.any(axis=-1))
+  eye = np.eye(N, dtype=bool)
+  for _ in range(MAX_QP_ITERATIONS):
+    act = active[todo]
+    kkt = np.zeros((len(todo), 2 * N, 2 * N))
+    kkt[:, :N, :N] = H[todo]
+    kkt[:, :N, N:] = -g_v.T * act[:, None, :]
+    kkt[:, N:, :N] = g_v * act[..., None]
+    kkt[:, N:, N:] = eye & ~act[..., None]
+    rhs = np.concatenate([-grad[todo], -v_free[todo] * act], axis=-1)
+    solved = np.linalg.solve(kkt, rhs[..., None])[..., 0]
+    u[todo], multipliers = solved[:, :N], solved[:, N:]
+    # Add violated nodes until feasible, then drop the ones holding the speed up
+    violated = (v_free[todo] + u[todo] @ g_v.T) < -1e-6
+    new_active = np.where(violated.any(axis=-1)[:, None], act | violated, act & (multipliers > 0.))
+    changed = np.any(new_active != act, axis=-1)
+    active[todo] = new_active
+    iterations[todo] += changed
+    todo = todo[changed]
+    if not len(todo):
+      break
+  return u, iterations
+
+
+def write_solution(out, states, u, x_l, v_l, a_l, cost):
+  out['x_ego'], out['v_ego'], out['a_ego'] = states[..., 0], states[..., 1], states[..., 2]
+  out['j_ego'] = u
+  out['x_l'], out['v_l'], out['a_l'] = x_l, v_l, a_l
+  out['t'] = T
+  out['cost'] = cost
+
+
+def solve_batch(x0, x_l, v_l, a_l_0, l, TR, costs, iterations=3, u_init=None):
+  """
+  Solves independent problems, all inputs broadcast along a leading batch axis
+  x0: (B, 3) x_ego, v_ego, a_ego. x_l, v_l, a_l_0, l, TR: (B,). costs: (B, 4) or (4,)
+  u_init: (B, N) jerks to start from, else from zero jerk linearized around stopping_rollout
+  Like with ACADO, problems with an unavoidable collision don't converge, check_solution flags them
+  Returns: (log_t records (B,), QP iterations of the last step (B,))
+  """
+  x0 = np.asarray(x0, dtype=np.float64)
+  batch = x0.shape[:-1]
+  TR = np.broadcast_to(np.asarray(TR, dtype=np.float64), batch)
+  lead_x, lead_v, lead_a = (np.broadcast_to(v, batch + (N + 1,)) for v in predict_lead(x_l, v_l, a_l_0, l))
+  weights = node_weights(costs)
+  if u_init is None:
+    u, states = np.zeros(batch + (N,)), stopping_rollout(x0)
+  else:
+    u = np.asarray(u_init, dtype=np.float64)
+    states = _states(x0, u)
+  for _ in range(iterations):
+    u, states, n_its = gauss_newton_step(x0, states, u, lead_x, lead_v, TR, weights)
+
+  out = np.zeros(batch, dtype=LOG_T_DTYPE)
+  write_solution(out, states, u, lead_x, lead_v, lead_a, objective(states, u, lead_x, lead_v, TR, weights))
+  return out, n_its
+
+
+class NumpyLibmpc:
+  """The libmpc functions over NumPy, keeps the last solution as the next linearization point like ACADO"""
+  def __init__(self, ffi, mpc_id):
+    self.ffi = ffi
+    self.mpc_id = mpc_id
+    self.weights = node_weights(np.zeros(4))
+    self.states = np.zeros((N + 1, 3))
+    self.u = np.zeros(N)
+
+  def init(self, ttcCost, distanceCost, accelerationCost, jerkCost):
+    self.change_costs(ttcCost, distanceCost, accelerationCost, jerkCost)
+    self.states = np.zeros((N + 1, 3))
+    self.u = np.zeros(N)
+
+  def change_costs(self, ttcCost, distanceCost, accelerationCost, jerkCost):
+    self.weights = node_weights([ttcCost, distanceCost, accelerationCost, jerkCost])
+
+  def init_with_simulation(self, v_ego, x_l, v_l, a_l, l):
+    # Constant decel that matches the lead speed at the lead, as in longitudinal_mpc.c
+    a_ego = min(-(v_ego - v_l) * (v_ego - v_l) / (2.0 * x_l + 0.01) + a_l, 0.)
+    x_ego = 0.
+    for i in range(N + 1):
+      self.states[i] = x_ego, v_ego, a_ego
+      dt = DT[min(i, N - 1)]
+      v_ego += a_ego * dt
+      if v_ego <= 0.:
+        v_ego = 0.
+        a_ego = 0.
+      x_ego += v_ego * dt
+    self.u = np.zeros(N)
+
+  def init_with_solution(self, solution):
+    sol = solution_view(self.ffi, solution)
+    self.states = np.stack([sol['x_ego'], sol['v_ego'], sol['a_ego']], axis=-1)
+    self.u = sol['j_ego'].copy()
+
+  def run_mpc(self, x0, solution, l, a_l_0, TR):
+    x0 = x0[0]
+    state = np.array([x0.x_ego, x0.v_ego, x0.a_ego])
+    lead_x, lead_v, lead_a = predict_lead(x0.x_l, x0.v_l, a_l_0, l)
+    TR = np.float64(TR)
+    self.states[0] = state
+    self.u, self.states, n_its = gauss_newton_step(state, self.states, self.u, lead_x, lead_v, TR, self.weights)
+    write_solution(solution_view(self.ffi, solution), self.states, self.u, lead_x, lead_v, lead_a,
+                   objective(self.states, self.u, lead_x, lead_v, TR, self.weights))
+    return int(n_its)
@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from enum import Enum
 import math
 import numpy as np
+import os
 from queue import Empty, Full, Queue
-import struct
+import select
 import subprocess
 from threading import Thread
 import time
 from common.params import Params
-from common.numpy_fast import interp
 
 import cereal.messaging as messaging
 from common.realtime import sec_since_boot
@@ -18,8 +18,32 @@ from selfdrive.config import Conversions as CV
 from selfdrive.controls.lib.speed_smoother import speed_smoother
 from selfdrive.controls.lib.longcontrol import LongCtrlState
 from selfdrive.controls.lib.fcw import FCWChecker
-from selfdrive.controls.lib.long_mpc import LongitudinalMpc
+from selfdrive.controls.lib.fcw_prescreen import FCWPrescreen
+from selfdrive.controls.lib.long_mpc import LongitudinalMpc, shift_plan
 from selfdrive.controls.lib.drive_helpers import V_CRUISE_MAX
+from selfdrive.controls.lib.patch_log import PatchLog
+from selfdrive.controls.lib.lookup_table import LookupTable
+from selfdrive.controls.lib.planner_stats import stats
+from selfdrive.controls.lib.plan_ring import PlanRing, SOURCES
+
+PATCH_PATH = '/data/openpilot-patch'
+BUTTON_PATH = '/dev/input/event0'
+BRIGHTNESS_PATH = '/sys/class/leds/lcd-backlight/brightness'
+# Per tick plan snapshots for other processes, see plan_ring.py. In RAM where there's a tmpfs
+PLAN_RING_PATH = os.environ.get('PLAN_RING_PATH', '/dev/shm/openpilot-patch-plan' if os.path.isdir('/dev/shm') else f'{PATCH_PATH}/plan_ring')
+
+# Solve mpc1 and mpc2 concurrently, cffi releases the GIL during run_mpc
+PARALLEL_MPC = os.environ.get('PARALLEL_MPC', False)
+# Budget for both solves together in s with PARALLEL_MPC, update raises on the tick past it. See update_mpcs
+MPC_SOLVE_TIMEOUT = float(os.environ.get('MPC_SOLVE_TIMEOUT', 0.1))
+# Budget for the solves of a tick in s, 0 to wait for them. See update_mpcs_deadline
+MPC_DEADLINE = float(os.environ.get('MPC_DEADLINE', 0.))
+# Skip solves without a lead while inputs barely change, see LongitudinalMpc
+NO_LEAD_CACHE = os.environ.get('NO_LEAD_CACHE', False)
+# Skip FCWChecker.update on ticks the planned accel can't raise an FCW, see FCWPrescreen
+FCW_PRESCREEN = os.environ.get('FCW_PRESCREEN', False)
+# Reinitialize the mpcs only when the lead tracker sees a different lead, not on every distance jump
+LEAD_TRACKING = os.environ.get('LEAD_TRACKING', False)
 
 LON_MPC_STEP = 0.2  # first step is 0.2s
 AWARENESS_DECEL = -0.2     # car smoothly decel at .2m/s^2 when user is distracted
@@ -39,102 +63,230 @@ _A_CRUISE_MAX_BP = [0.,  6.4, 22.5, 40.]
 _A_TOTAL_MAX_V = [1.7, 3.2]
 _A_TOTAL_MAX_BP = [20., 40.]
 
+_A_CRUISE_MIN = LookupTable(_A_CRUISE_MIN_BP, _A_CRUISE_MIN_V)
+_A_CRUISE_MAX = LookupTable(_A_CRUISE_MAX_BP, _A_CRUISE_MAX_V)
+_A_CRUISE_MAX_FOLLOWING = LookupTable(_A_CRUISE_MAX_BP, _A_CRUISE_MAX_V_FOLLOWING)
+_A_TOTAL_MAX = LookupTable(_A_TOTAL_MAX_BP, _A_TOTAL_MAX_V)
+
 
 class InputEvent(Enum):
   SHORT_PRESS = 1
   LONG_PRESS = 2
 
 
-def input_loop(input_queue):
-  log_f = open('/data/openpilot-patch/input_log.txt', 'a')
+# struct input_event on a 64 bit kernel: timeval (as 4 uints), type, code, value
+INPUT_EVENT_DTYPE = np.dtype([('time', '<u4', 4), ('type', '<u2'), ('code', '<u2'), ('value', '<u4')])
+KEY_VOLUMEDOWN = 114
+
+
+class ButtonReader:
+  """
+  Reads evdev events in bulk into a preallocated buffer, decodes them in one pass
+  and can be stopped from another thread while waiting
+  """
+  def __init__(self, path, keycode=KEY_VOLUMEDOWN, max_events=64):
+    self.path = path
+    self.keycode = keycode
+    self.fd = None
+    self.buf = bytearray(INPUT_EVENT_DTYPE.itemsize * max_events)
+    self.view = memoryview(self.buf)
+    self.pending = 0  # bytes of a partial event at the start of buf
+    self.stop_r, self.stop_w = os.pipe()
+    self.poller = select.poll()
+    self.poller.register(self.stop_r, select.POLLIN)
+
+  def open(self):
+    self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+    self.poller.register(self.fd, select.POLLIN)
+
+  def stop(self):
+    if self.stop_w is not None:
+      os.write(self.stop_w, b'\0')
+
+  def close(self):
+    # The stop pipe stays open, stop() may still be called after the reader is done
+    if self.fd is not None:
+      self.poller.unregister(self.fd)
+      os.close(self.fd)
+      self.fd = None
+
+  def release(self):
+    """Closes the stop pipe once nothing reads anymore, stop() is a no-op after"""
+    if self.stop_r is not None:
+      self.poller.unregister(self.stop_r)
+      os.close(self.stop_r)
+      os.close(self.stop_w)
+      self.stop_r = self.stop_w = None
+
+  def read(self, timeout=None):
+    """
+    Waits up to timeout seconds, forever if None
+    Returns: array of events with the keycode, None once stopped or the device is closed
+    """
+    ready = dict(self.poller.poll(None if timeout is None else timeout * 1000.))
+    if self.stop_r in ready:
+      return None
+    if self.fd not in ready:
+      return np.empty(0, INPUT_EVENT_DTYPE)
+
+    try:
+      n = os.readv(self.fd, [self.view[self.pending:]])
+    except BlockingIOError:
+      n = -1
+    if n == 0:
+      return None
+    total = self.pending + max(n, 0)
+    count = total // INPUT_EVENT_DTYPE.itemsize
+    events = np.frombuffer(self.buf, dtype=INPUT_EVENT_DTYPE, count=count)
+    events = events[events['code'] == self.keycode]  # copies, buf can be reused
+
+    used = count * INPUT_EVENT_DTYPE.itemsize
+    self.pending = total - used
+    self.buf[:self.pending] = self.buf[used:total]
+    return events
+
+
+def event_time(event):
+  sec = int(event['time'][0]) | int(event['time'][1]) << 32
+  usec = int(event['time'][2]) | int(event['time'][3]) << 32
+  return sec + usec * 1e-6
 
-  def input_log(message):
-    log_f.write(f"{datetime.now()} {message}\n")
-    log_f.flush()
 
+def input_loop(input_queue, reader, input_log):
   try:
-    button_file = open('/dev/input/event0', 'rb')
+    reader.open()
     is_pressed = None
-    state_change_time = time.monotonic()
+    state_change_time = None
 
     short_press_range = (0., 0.5)
     long_press_range = (1.5, 3.)
 
     while True:
-      button_data = button_file.read(24)
-      button_fields = struct.unpack('4IHHI', button_data)
-      if button_fields[5] != 114: # Volume down
-        continue
-      new_state_change_time = time.monotonic()
-      time_in_state = new_state_change_time - state_change_time
-      new_is_pressed = button_fields[6] == 1
-
-      if is_pressed is None:
-        input_log("First state change")
-      elif not is_pressed and new_is_pressed:
-        input_log("Press started")
-      elif is_pressed and not new_is_pressed:
-        if short_press_range[0] <= time_in_state <= short_press_range[1]:
-          input_log(f"Short press finished: {time_in_state}")
-          input_queue.put(InputEvent.SHORT_PRESS)
-        elif long_press_range[0] <= time_in_state <= long_press_range[1]:
-          input_log(f"Long press finished: {time_in_state}")
-          input_queue.put(InputEvent.LONG_PRESS)
-        else:
-          input_log("Unknown press finished")
-      else: # Two pressed or two depressed events in a row
-        input_log(f"Some press inconsistency - is_pressed:{is_pressed} new_is_pressed:{new_is_pressed} duration:{time_in_state}")
-      is_pressed = new_is_pressed
-      state_change_time = new_state_change_time
+      events = reader.read()
+      if events is None:
+        input_log("Input reader stopped")
+        break
+
+      for event in events:
+        # Kernel timestamps, events decoded from the same read keep their real spacing
+        new_state_change_time = event_time(event)
+        time_in_state = 0. if state_change_time is None else new_state_change_time - state_change_time
+        new_is_pressed = event['value'] == 1
+
+        if is_pressed is None:
+          input_log("First state change")
+        elif not is_pressed and new_is_pressed:
+          input_log("Press started")
+        elif is_pressed and not new_is_pressed:
+          if short_press_range[0] <= time_in_state <= short_press_range[1]:
+            input_log(f"Short press finished: {time_in_state}")
+            input_queue.put(InputEvent.SHORT_PRESS)
+          elif long_press_range[0] <= time_in_state <= long_press_range[1]:
+            input_log(f"Long press finished: {time_in_state}")
+            input_queue.put(InputEvent.LONG_PRESS)
+          else:
+            input_log("Unknown press finished")
+        else: # Two pressed or two depressed events in a row
+          input_log(f"Some press inconsistency - is_pressed:{is_pressed} new_is_pressed:{new_is_pressed} duration:{time_in_state}")
+        is_pressed = new_is_pressed
+        state_change_time = new_state_change_time
   except Exception as e:
     input_log(f"Input loop exception: {e}")
-    subprocess.Popen(['python', '/data/openpilot-patch/util/error.py'])
+    subprocess.Popen(['python', f'{PATCH_PATH}/util/error.py'])
+  finally:
+    reader.close()
 
 
 class OutputEvent(Enum):
   SHORT_DIM = 1
   LONG_DIM = 2
 
-def dim(duration):
-  brightness_path = '/sys/class/leds/lcd-backlight/brightness'
-  with open(brightness_path, 'r') as brightness_f:
-    start_brightness = brightness_f.read()
-  with open(brightness_path, 'w') as brightness_f:
-    brightness_f.write(str(int(start_brightness) // 2))
-  time.sleep(duration)
-  with open(brightness_path, 'w') as brightness_f:
-    brightness_f.write(start_brightness)
+DIM_DURATIONS = {OutputEvent.SHORT_DIM: 1.0, OutputEvent.LONG_DIM: 3.0}  # s
+# Events are only queued while the output thread is stuck or dead, drop the newest then
+OUTPUT_QUEUE_SIZE = 4
+
+
+class Backlight:
+  """Keeps the brightness file open and rewrites it in place"""
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+
+  def open(self):
+    self.fd = os.open(self.path, os.O_RDWR)
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def read(self):
+    return int(os.pread(self.fd, 32, 0))
 
+  def write(self, brightness):
+    data = str(brightness).encode()
+    os.pwrite(self.fd, data, 0)
+    os.ftruncate(self.fd, len(data))  # no-op on sysfs, needed for a regular file standing in for it
 
-def output_loop(output_queue):
-  log_f = open('/data/openpilot-patch/output_log.txt', 'a')
 
-  def output_log(message):
-    log_f.write(f"{datetime.now()} {message}\n")
-    log_f.flush()
+def output_loop(output_queue, backlight, output_log):
+  """
+  Dims the screen to half brightness for a while per output event without sleeping.
+  An event while dimmed replaces the pending restore, which goes back to the brightness
+  from before the first dim unless something else changed it meanwhile
+  """
+  restore_at = None  # monotonic time, None while not dimmed
+
+  def restore():
+    if backlight.read() == dimmed:
+      backlight.write(baseline)
 
   try:
+    backlight.open()
     while True:
-      output_event = output_queue.get(block=True)
-      if output_event == OutputEvent.SHORT_DIM:
-        output_log("Dim for 1s")
-        dim(1.0)
-      elif output_event == OutputEvent.LONG_DIM:
-        output_log("Dim for 3s")
-        dim(3.0)
+      timeout = None if restore_at is None else max(restore_at - time.monotonic(), 0.)
+      try:
+        output_event = output_queue.get(timeout=timeout)
+      except Empty:
+        restore()
+        restore_at = None
+        continue
+
+      if output_event is None:  # Shutdown
+        if restore_at is not None:
+          restore()
+        break
+
+      duration = DIM_DURATIONS[output_event]
+      if restore_at is None:
+        baseline = backlight.read()
+        dimmed = baseline // 2
+        backlight.write(dimmed)
+        output_log(f"Dim for {duration}s")
+      else:
+        output_log(f"Dim for {duration}s, replacing the pending restore")
+      restore_at = time.monotonic() + duration
   except Exception as e:
-    output_log(f"Output loop exception: {e}\n")
-    subprocess.Popen(['python', '/data/openpilot-patch/util/error.py'])
+    output_log(f"Output loop exception: {e}")
+    subprocess.Popen(['python', f'{PATCH_PATH}/util/error.py'])
+  finally:
+    backlight.close()
 
 
 def calc_cruise_accel_limits(v_ego, following):
-  a_cruise_min = interp(v_ego, _A_CRUISE_MIN_BP, _A_CRUISE_MIN_V)
+  a_cruise_min = _A_CRUISE_MIN(v_ego)
 
   if following:
-    a_cruise_max = interp(v_ego, _A_CRUISE_MAX_BP, _A_CRUISE_MAX_V_FOLLOWING)
+    a_cruise_max = _A_CRUISE_MAX_FOLLOWING(v_ego)
   else:
-    a_cruise_max = interp(v_ego, _A_CRUISE_MAX_BP, _A_CRUISE_MAX_V)
-  return np.vstack([a_cruise_min, a_cruise_max])
+    a_cruise_max = _A_CRUISE_MAX(v_ego)
+  return [a_cruise_min, a_cruise_max]
+
+
+def calc_cruise_accel_limits_batch(v_ego, following):
+  """calc_cruise_accel_limits over arrays of speeds and following flags, returns a 2xN array"""
+  a_cruise_max = np.where(following, _A_CRUISE_MAX_FOLLOWING.batch(v_ego), _A_CRUISE_MAX.batch(v_ego))
+  return np.vstack([_A_CRUISE_MIN.batch(v_ego), a_cruise_max])
 
 
 def limit_accel_in_turns(v_ego, angle_steers, a_target, CP):
@@ -143,7 +295,7 @@ def limit_accel_in_turns(v_ego, angle_steers, a_target, CP):
   this should avoid accelerating when losing the target in turns
   """
 
-  a_total_max = interp(v_ego, _A_TOTAL_MAX_BP, _A_TOTAL_MAX_V)
+  a_total_max = _A_TOTAL_MAX(v_ego)
   a_y = v_ego**2 * angle_steers * CV.DEG_TO_RAD / (CP.steerRatio * CP.wheelbase)
   a_x_allowed = math.sqrt(max(a_total_max**2 - a_y**2, 0.))
 
@@ -154,8 +306,15 @@ class Planner():
   def __init__(self, CP):
     self.CP = CP
 
-    self.mpc1 = LongitudinalMpc(1)
-    self.mpc2 = LongitudinalMpc(2)
+    self.mpc1 = LongitudinalMpc(1, no_lead_cache=NO_LEAD_CACHE, lead_tracking=LEAD_TRACKING)
+    self.mpc2 = LongitudinalMpc(2, no_lead_cache=NO_LEAD_CACHE, lead_tracking=LEAD_TRACKING)
+    self.mpc_deadline = MPC_DEADLINE
+    self.mpc_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='mpc') if PARALLEL_MPC or self.mpc_deadline else None
+    # What choose_solution and publish read: the mpc itself, or its shifted last plan while a solve overruns
+    self.plan1 = self.mpc1
+    self.plan2 = self.mpc2
+    self.mpc_futures = {}  # mpc -> overrunning solve
+    self.last_plans = {}  # mpc -> MpcPlan of its last solve in time
 
     self.v_acc_start = 0.0
     self.a_acc_start = 0.0
@@ -170,6 +329,7 @@ class Planner():
 
     self.longitudinalPlanSource = 'cruise'
     self.fcw_checker = FCWChecker()
+    self.fcw_prescreen = FCWPrescreen() if FCW_PRESCREEN else None
     self.path_x = np.arange(192)
 
     self.fcw = False
@@ -177,42 +337,157 @@ class Planner():
     self.params = Params()
     self.first_loop = True
 
+    self.log = PatchLog(f'{PATCH_PATH}/planner_log.txt')
+
     self.input_queue = Queue()
-    self.input_thread = Thread(target=input_loop, args=(self.input_queue,))
+    self.button_reader = ButtonReader(BUTTON_PATH)
+    self.input_thread = Thread(target=input_loop, args=(self.input_queue, self.button_reader, self.log.logger('input')),
+                               daemon=True)
     self.input_thread.start()
 
-    self.output_queue = Queue()
-    self.output_thread = Thread(target=output_loop, args=(self.output_queue,))
+    self.output_queue = Queue(maxsize=OUTPUT_QUEUE_SIZE)
+    self.output_thread = Thread(target=output_loop, args=(self.output_queue, Backlight(BRIGHTNESS_PATH), self.log.logger('output')),
+                                daemon=True)
     self.output_thread.start()
 
     self.TR_override = None
 
+    self.update_time = stats.histogram('planner.update')
+    self.cruise_time = stats.histogram('planner.cruise')
+    self.mpcs_time = stats.histogram('planner.mpcs')
+    self.fcw_time = stats.histogram('planner.fcw')
+    self.publish_time = stats.histogram('planner.publish')
+    for mpc in (self.mpc1, self.mpc2):
+      name = f'mpc{mpc.mpc_id}'
+      stats.gauge(f'{name}.new_leads', lambda mpc=mpc: mpc.new_leads)
+      stats.gauge(f'{name}.lead_changes', lambda mpc=mpc: mpc.lead_changes)
+      stats.gauge(f'{name}.spurious_new_leads', lambda mpc=mpc: mpc.spurious_new_leads)
+      stats.gauge(f'{name}.warm_resets', lambda mpc=mpc: mpc.warm_resets)
+      stats.gauge(f'{name}.cold_resets', lambda mpc=mpc: mpc.cold_resets)
+      stats.gauge(f'{name}.cost_changes', lambda mpc=mpc: mpc.dynamic_follow.cost_changes)
+      stats.gauge(f'{name}.no_lead_hits', lambda mpc=mpc: mpc.no_lead_hits)
+      if self.mpc_executor is not None:
+        for counter in ('overruns', 'busy_ticks', 'resyncs'):
+          stats.count(f'{name}.{counter}', 0)
+    stats.gauge('log.dropped', lambda: self.log.dropped)
+    if self.fcw_prescreen is not None:
+      stats.gauge('fcw.prescreen_skips', lambda: self.fcw_prescreen.skips)
+      stats.gauge('fcw.prescreen_checks', lambda: self.fcw_prescreen.checks)
+    try:
+      # Connect to get a JSON snapshot, e.g. socat - UNIX-CONNECT:planner_stats.sock
+      self.stats_socket = stats.serve(f'{PATCH_PATH}/planner_stats.sock')
+    except OSError as e:
+      self.stats_socket = None
+      self.log.write('planner', f"Stats socket unavailable: {e}")
+    try:
+      self.plan_ring = PlanRing(PLAN_RING_PATH)
+    except OSError as e:
+      self.plan_ring = None
+      self.log.write('planner', f"Plan ring unavailable: {e}")
+
+  def stop(self, timeout=5.):
+    """Stops the button, brightness, stats, mpc and log threads. Safe to call again"""
+    if self.stats_socket is not None:
+      stats.stop_serving(self.stats_socket)
+      self.stats_socket = None
+    if self.plan_ring is not None:
+      self.plan_ring.close()
+      self.plan_ring = None
+    self.button_reader.stop()
+    try:
+      self.output_queue.put(None, timeout=timeout)
+    except Full:
+      pass
+    self.input_thread.join(timeout)
+    if not self.input_thread.is_alive():
+      self.button_reader.release()
+    self.output_thread.join(timeout)
+    if self.mpc_executor is not None:
+      self.mpc_executor.shutdown(wait=False, cancel_futures=True)
+    self.log.stop(timeout)
+
   def choose_solution(self, v_cruise_setpoint, enabled):
     if enabled:
       solutions = {'cruise': self.v_cruise}
-      if self.mpc1.prev_lead_status:
-        solutions['mpc1'] = self.mpc1.v_mpc
-      if self.mpc2.prev_lead_status:
-        solutions['mpc2'] = self.mpc2.v_mpc
+      if self.plan1.prev_lead_status:
+        solutions['mpc1'] = self.plan1.v_mpc
+      if self.plan2.prev_lead_status:
+        solutions['mpc2'] = self.plan2.v_mpc
 
       slowest = min(solutions, key=solutions.get)
 
       self.longitudinalPlanSource = slowest
       # Choose lowest of MPC and cruise
       if slowest == 'mpc1':
-        self.v_acc = self.mpc1.v_mpc
-        self.a_acc = self.mpc1.a_mpc
+        self.v_acc = self.plan1.v_mpc
+        self.a_acc = self.plan1.a_mpc
       elif slowest == 'mpc2':
-        self.v_acc = self.mpc2.v_mpc
-        self.a_acc = self.mpc2.a_mpc
+        self.v_acc = self.plan2.v_mpc
+        self.a_acc = self.plan2.a_mpc
       elif slowest == 'cruise':
         self.v_acc = self.v_cruise
         self.a_acc = self.a_cruise
 
-    self.v_acc_future = min([self.mpc1.v_mpc_future, self.mpc2.v_mpc_future, v_cruise_setpoint])
+    self.v_acc_future = min([self.plan1.v_mpc_future, self.plan2.v_mpc_future, v_cruise_setpoint])
+
+  def update_mpcs(self, CS, lead_1, lead_2, t):
+    """
+    Solves both mpcs, concurrently with PARALLEL_MPC. The tick a solve runs past MPC_SOLVE_TIMEOUT raises,
+    the following ones go on without it like update_mpcs_deadline does until it's done
+    """
+    if self.mpc_executor is None:
+      self.mpc1.set_cur_state(self.v_acc_start, self.a_acc_start)
+      self.mpc2.set_cur_state(self.v_acc_start, self.a_acc_start)
+      self.mpc1.update(CS, lead_1, self.TR_override)
+      self.mpc2.update(CS, lead_2, self.TR_override)
+      return
+
+    overruns = self.update_mpcs_deadline(CS, lead_1, lead_2, t, MPC_SOLVE_TIMEOUT)
+    if overruns:
+      raise FuturesTimeout(f'mpc{overruns[0].mpc_id} solve ran past {MPC_SOLVE_TIMEOUT} s')
+
+  def update_mpcs_deadline(self, CS, lead_1, lead_2, t, budget):
+    """
+    Solves within budget seconds. An mpc that overruns keeps solving in the background, untouched
+    until it's done, while this and the following ticks plan from its last plan shifted to now, or
+    cruise without a lead to follow. Once done it's resynced from its last good trajectory
+    Returns: the mpcs that overran this tick
+    """
+    deadline = time.monotonic() + budget
+    submitted = {}
+    for mpc, lead in ((self.mpc1, lead_1), (self.mpc2, lead_2)):
+      future = self.mpc_futures.get(mpc)
+      if future is not None:
+        if not future.done():
+          stats.count(f'mpc{mpc.mpc_id}.busy_ticks')
+          continue
+        del self.mpc_futures[mpc]
+        future.result()  # worker exceptions are raised here
+        mpc.resync(t)
+        stats.count(f'mpc{mpc.mpc_id}.resyncs')
+      mpc.set_cur_state(self.v_acc_start, self.a_acc_start)
+      submitted[mpc] = self.mpc_executor.submit(mpc.update, CS, lead, self.TR_override)
+
+    plans, overruns = [], []
+    for mpc in (self.mpc1, self.mpc2):
+      future = submitted.get(mpc)
+      if future is not None:
+        try:
+          future.result(timeout=max(deadline - time.monotonic(), 0.))
+          self.last_plans[mpc] = mpc.plan(t)
+          plans.append(mpc)
+          continue
+        except FuturesTimeout:
+          stats.count(f'mpc{mpc.mpc_id}.overruns')
+          self.mpc_futures[mpc] = future
+          overruns.append(mpc)
+      plans.append(shift_plan(self.last_plans.get(mpc), t))
+    self.plan1, self.plan2 = plans
+    return overruns
 
   def update(self, sm, CP):
     """Gets called when new radarState is available"""
+    start = time.monotonic_ns()
     cur_time = sec_since_boot()
 
     try:
@@ -226,10 +501,9 @@ class Planner():
       try:
         self.output_queue.put_nowait(output_event)
       except Full:
-        log_f = open('/data/openpilot-patch/mpc_update_log.txt', 'a')
-        log_f.write(f"{datetime.now()} Output queue is full\n")
-        log_f.flush()
-        subprocess.Popen(['python', '/data/openpilot-patch/util/error.py'])
+        # Only a stuck or dead output thread gets here, output_loop starts the error blinker when it dies
+        stats.count('output_queue.full')
+        self.log.write('planner', "Output queue is full, dropping the event")
     except TimeoutError:
       pass
     except Empty:
@@ -253,9 +527,10 @@ class Planner():
     self.v_acc_start = self.v_acc_next
     self.a_acc_start = self.a_acc_next
 
+    cruise_start = time.monotonic_ns()
     # Calculate speed for normal cruise control
     if enabled and not self.first_loop and not sm['carState'].gasPressed:
-      accel_limits = [float(x) for x in calc_cruise_accel_limits(v_ego, following)]
+      accel_limits = calc_cruise_accel_limits(v_ego, following)
       jerk_limits = [min(-0.1, accel_limits[0]), max(0.1, accel_limits[1])]  # TODO: make a separate lookup for jerk tuning
       accel_limits_turns = limit_accel_in_turns(v_ego, sm['carState'].steeringAngleDeg, accel_limits, self.CP)
 
@@ -284,27 +559,38 @@ class Planner():
       self.v_cruise = reset_speed
       self.a_cruise = reset_accel
 
-    self.mpc1.set_cur_state(self.v_acc_start, self.a_acc_start)
-    self.mpc2.set_cur_state(self.v_acc_start, self.a_acc_start)
+    mpcs_start = time.monotonic_ns()
+    self.cruise_time.add(mpcs_start - cruise_start)
 
-    self.mpc1.update(sm['carState'], lead_1, self.TR_override)
-    self.mpc2.update(sm['carState'], lead_2, self.TR_override)
+    if self.mpc_deadline:
+      self.update_mpcs_deadline(sm['carState'], lead_1, lead_2, cur_time, self.mpc_deadline)
+    else:
+      self.update_mpcs(sm['carState'], lead_1, lead_2, cur_time)
 
     self.choose_solution(v_cruise_setpoint, enabled)
 
-    # determine fcw
-    if self.mpc1.new_lead:
-      self.fcw_checker.reset_lead(cur_time)
-
-    blinkers = sm['carState'].leftBlinker or sm['carState'].rightBlinker
-    self.fcw = self.fcw_checker.update(self.mpc1.mpc_solution, cur_time,
-                                       sm['controlsState'].active,
-                                       v_ego, sm['carState'].aEgo,
-                                       lead_1.dRel, lead_1.vLead, lead_1.aLeadK,
-                                       lead_1.yRel, lead_1.vLat,
-                                       lead_1.fcw, blinkers) and not sm['carState'].brakePressed
-    if self.fcw:
-      cloudlog.info("FCW triggered %s", self.fcw_checker.counters)
+    fcw_start = time.monotonic_ns()
+    self.mpcs_time.add(fcw_start - mpcs_start)
+
+    # determine fcw, held while mpc1 overruns
+    if self.plan1 is self.mpc1:
+      if self.mpc1.new_lead:
+        self.fcw_checker.reset_lead(cur_time)
+
+      blinkers = sm['carState'].leftBlinker or sm['carState'].rightBlinker
+      fcw_args = (cur_time, sm['controlsState'].active,
+                  v_ego, sm['carState'].aEgo,
+                  lead_1.dRel, lead_1.vLead, lead_1.aLeadK,
+                  lead_1.yRel, lead_1.vLat,
+                  lead_1.fcw, blinkers)
+      if self.fcw_prescreen is not None:
+        fcw = self.fcw_prescreen.update(self.fcw_checker, self.mpc1.solution_view, self.mpc1.mpc_solution, *fcw_args)
+      else:
+        fcw = self.fcw_checker.update(self.mpc1.mpc_solution, *fcw_args)
+      self.fcw = fcw and not sm['carState'].brakePressed
+      if self.fcw:
+        cloudlog.info("FCW triggered %s", self.fcw_checker.counters)
+    self.fcw_time.add(time.monotonic_ns() - fcw_start)
 
     # Interpolate 0.05 seconds and save as starting point for next iteration
     a_acc_sol = self.a_acc_start + (CP.radarTimeStep / LON_MPC_STEP) * (self.a_acc - self.a_acc_start)
@@ -313,10 +599,15 @@ class Planner():
     self.a_acc_next = a_acc_sol
 
     self.first_loop = False
+    self.update_time.add(time.monotonic_ns() - start)
 
   def publish(self, sm, pm):
-    self.mpc1.publish(pm)
-    self.mpc2.publish(pm)
+    start = time.monotonic_ns()
+    # An overrunning mpc is still writing its solution
+    if self.plan1 is self.mpc1:
+      self.mpc1.publish(pm)
+    if self.plan2 is self.mpc2:
+      self.mpc2.publish(pm)
 
     plan_send = messaging.new_message('longitudinalPlan')
 
@@ -333,10 +624,27 @@ class Planner():
     longitudinalPlan.vTarget = float(self.v_acc)
     longitudinalPlan.aTarget = float(self.a_acc)
     longitudinalPlan.vTargetFuture = float(self.v_acc_future)
-    longitudinalPlan.hasLead = self.mpc1.prev_lead_status
+    longitudinalPlan.hasLead = bool(self.plan1.prev_lead_status)
     longitudinalPlan.longitudinalPlanSource = self.longitudinalPlanSource
     longitudinalPlan.fcw = self.fcw
 
     longitudinalPlan.processingDelay = (plan_send.logMonoTime / 1e9) - sm.rcv_time['radarState']
 
     pm.send('longitudinalPlan', plan_send)
+    self.publish_time.add(time.monotonic_ns() - start)
+    if self.plan_ring is not None:
+      self.write_plan_ring()
+
+  def write_plan_ring(self):
+    mpc1, mpc2 = self.mpc1, self.mpc2
+    self.plan_ring.write((
+      time.monotonic(), self.v_cruise, self.a_cruise, self.v_acc_start, self.a_acc_start,
+      self.v_acc, self.a_acc, self.v_acc_future, mpc1.dynamic_follow.TR,
+      self.TR_override if self.TR_override is not None else math.nan,
+      self.cruise_time.last, self.mpcs_time.last, self.fcw_time.last, self.update_time.last, self.publish_time.last,
+      SOURCES.index(self.longitudinalPlanSource), bool(self.plan1.prev_lead_status), self.fcw,
+      self.plan1 is not mpc1, self.plan2 is not mpc2,
+      mpc1.duration, mpc2.duration, mpc1.n_its, mpc2.n_its, mpc1.new_leads, mpc2.new_leads,
+      mpc1.warm_resets, mpc2.warm_resets, mpc1.cold_resets, mpc2.cold_resets,
+    ), mpc1.solution_view if self.plan1 is mpc1 else self.plan1.solution,
+       mpc2.solution_view if self.plan2 is mpc2 else self.plan2.solution)
@@ -0,0 +1,37 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class LookupTable:
+  """
+  Piecewise linear table with interp semantics (clamped at both ends).
+  Breakpoints and slopes are computed once, the scalar path allocates nothing
+  and the batched path evaluates arrays of any shape with NumPy.
+  Both paths compute slope * (x - bp) + value, so they agree bit for bit.
+  """
+  __slots__ = ('bp', 'v', 'slopes', '_bp_first', '_bp_last', '_v_first', '_v_last', '_bp_array', '_v_array')
+
+  def __init__(self, bp, v):
+    assert len(bp) == len(v) and len(bp) > 0
+    assert all(b0 < b1 for b0, b1 in zip(bp, bp[1:])), "breakpoints must be increasing"
+
+    self.bp = tuple(float(x) for x in bp)
+    self.v = tuple(float(x) for x in v)
+    self.slopes = tuple((v1 - v0) / (b1 - b0) for b0, b1, v0, v1 in zip(self.bp, self.bp[1:], self.v, self.v[1:]))
+
+    self._bp_first, self._bp_last = self.bp[0], self.bp[-1]
+    self._v_first, self._v_last = self.v[0], self.v[-1]
+    self._bp_array = np.array(self.bp)
+    self._v_array = np.array(self.v)
+
+  def __call__(self, x):
+    if x <= self._bp_first:
+      return self._v_first
+    if x >= self._bp_last:
+      return self._v_last
+    i = bisect_right(self.bp, x) - 1
+    return self.slopes[i] * (x - self.bp[i]) + self.v[i]
+
+  def batch(self, x):
+    return np.interp(x, self._bp_array, self._v_array)
@@ -0,0 +1,78 @@
+from collections import deque
+from datetime import datetime
+import os
+from threading import Event, Thread
+import time
+
+
+class PatchLog:
+  """
+  Shared sink for the planner side-channel logs. write() only appends to a bounded
+  in-memory queue, a background thread formats and writes batches, rotating by size.
+  When the queue is full messages are dropped and counted instead of blocking.
+  """
+  def __init__(self, path, max_queue=1024, max_bytes=1 << 20, flush_interval=1.0):
+    self.path = path
+    self.max_queue = max_queue
+    self.max_bytes = max_bytes
+    self.flush_interval = flush_interval
+
+    self.queue = deque()
+    self.dropped = 0
+    self.written = 0
+    self._reported_dropped = 0
+
+    self._stop = Event()
+    self._f = None
+    self._thread = Thread(target=self._writer_loop, daemon=True)
+    self._thread.start()
+
+  def write(self, source, message):
+    if len(self.queue) >= self.max_queue:
+      self.dropped += 1
+      return
+    self.queue.append((time.monotonic(), source, message))
+
+  def logger(self, source):
+    return lambda message: self.write(source, message)
+
+  def stop(self, timeout=5.):
+    self._stop.set()
+    self._thread.join(timeout)
+
+  def _open(self):
+    self._f = open(self.path, 'a')
+    # Entries carry monotonic time, this line maps it to wall time
+    self._f.write(f"{time.monotonic():.3f} [log] opened at {datetime.now()}\n")
+
+  def _rotate(self):
+    self._f.close()
+    os.replace(self.path, f'{self.path}.1')
+    self._open()
+
+  def _flush(self):
+    lines = []
+    while self.queue:
+      t, source, message = self.queue.popleft()
+      lines.append(f"{t:.3f} [{source}] {message}\n")
+    dropped = self.dropped
+    if dropped != self._reported_dropped:
+      lines.append(f"{time.monotonic():.3f} [log] dropped {dropped - self._reported_dropped} messages\n")
+      self._reported_dropped = dropped
+    if not lines:
+      return
+
+    self._f.write(''.join(lines))
+    self._f.flush()
+    self.written += len(lines)
+    if self._f.tell() > self.max_bytes:
+      self._rotate()
+
+  def _writer_loop(self):
+    self._open()
+    try:
+      while not self._stop.wait(self.flush_interval):
+        self._flush()
+      self._flush()
+    finally:
+      self._f.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Fixed layout ring of per tick plan snapshots in a memory-mapped file, so dashboards and tuning
+tools in other processes can follow the planner without subscribing to its messages or adding
+code to it. The planner writes one slot per tick, readers never write or signal anything.
+
+Layout: a 64 byte header, then N_SLOTS slots of SLOT_DTYPE. Tick k goes to slot k % N_SLOTS
+and its seq is 2k + 1 while written and 2k + 2 once done. The header's head is the number of
+ticks written. A reader copies a slot and checks seq is the same before and after the copy,
+anything else is a torn read or an overwritten tick.
+
+  python selfdrive/controls/lib/plan_ring.py  # prints ticks as they're written
+"""
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from selfdrive.controls.lib.longitudinal_mpc.libmpc_py import LOG_T_DTYPE
+
+MAGIC = b'OPPLANRG'
+VERSION = 1
+N_SLOTS = 256  # 12.8 s at 20 Hz
+HEADER_SIZE = 64
+
+SOURCES = ('cruise', 'mpc1', 'mpc2')
+STAGES = ('cruise', 'mpcs', 'fcw', 'update', 'publish')
+
+PLAN_DTYPE = np.dtype([
+  ('mono_time', np.float64),  # time.monotonic() when written
+  ('v_cruise', np.float64),
+  ('a_cruise', np.float64),
+  ('v_start', np.float64),
+  ('a_start', np.float64),
+  ('v_target', np.float64),
+  ('a_target', np.float64),
+  ('v_target_future', np.float64),
+  ('TR', np.float64),  # of mpc1
+  ('TR_override', np.float64),  # nan without
+  ('stage_ns', np.int64, len(STAGES)),
+  ('source', np.uint8),  # index into SOURCES
+  ('has_lead', np.uint8),
+  ('fcw', np.uint8),
+  ('overrun', np.uint8, 2),  # per mpc, its horizon is then the last plan it finished
+  ('solve_ns', np.int64, 2),
+  ('n_its', np.int64, 2),
+  ('new_leads', np.int64, 2),
+  ('warm_resets', np.int64, 2),
+  ('cold_resets', np.int64, 2),
+])
+
+
+def _struct_format(dtype):
+  codes = {np.dtype(np.float64): 'd', np.dtype(np.int64): 'q', np.dtype(np.uint8): 'B'}
+  fmt = '<'
+  for name in dtype.names:
+    field = dtype.fields[name][0]
+    fmt += f'{int(np.prod(field.shape))}{codes[field.base]}'
+  return fmt
+
+
+# Packs a plan from flat values straight into its slot, several times faster than assigning a tuple to PLAN_DTYPE
+PLAN_STRUCT = struct.Struct(_struct_format(PLAN_DTYPE))
+assert PLAN_STRUCT.size == PLAN_DTYPE.itemsize
+
+HEADER_DTYPE = np.dtype({
+  'names': ['magic', 'version', 'n_slots', 'slot_size', 'head'],
+  'formats': ['S8', np.uint32, np.uint32, np.uint32, np.uint64],
+  'offsets': [0, 8, 12, 16, 24],
+  'itemsize': HEADER_SIZE,
+})
+
+
+def _slot_dtype():
+  fields = np.dtype([('seq', np.uint64), ('plan', PLAN_DTYPE), ('horizons', LOG_T_DTYPE, 2)])
+  # Whole cache lines, so seq is never split from or shares a line with the slot before
+  return np.dtype({'names': list(fields.names), 'formats': [fields.fields[n][0] for n in fields.names],
+                   'offsets': [fields.fields[n][1] for n in fields.names], 'itemsize': -(-fields.itemsize // 64) * 64})
+
+
+SLOT_DTYPE = _slot_dtype()
+FILE_SIZE = HEADER_SIZE + N_SLOTS * SLOT_DTYPE.itemsize
+
+
+class PlanRing:
+  """Writer side, the planner's"""
+  def __init__(self, path):
+    # Built aside and moved in place, a reader mapping an old ring never sees it truncated
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.truncate(FILE_SIZE)
+    with open(tmp_path, 'r+b') as f:
+      self._mm = mmap.mmap(f.fileno(), FILE_SIZE)
+    self.header = np.frombuffer(self._mm, HEADER_DTYPE, 1)
+    self.header[0] = (MAGIC, VERSION, N_SLOTS, SLOT_DTYPE.itemsize, 0)
+    os.replace(tmp_path, path)
+
+    slots = np.frombuffer(self._mm, SLOT_DTYPE, N_SLOTS, HEADER_SIZE)
+    self.seqs = slots['seq']
+    self.horizons = slots['horizons']
+    self.plan_offsets = [HEADER_SIZE + i * SLOT_DTYPE.itemsize + SLOT_DTYPE.fields['plan'][1] for i in range(N_SLOTS)]
+    self.head = 0
+
+  def write(self, plan, horizon1, horizon2):
+    """plan: PLAN_DTYPE fields flattened in order, horizons: log_t views, None for an empty one"""
+    k = self.head
+    i = k % N_SLOTS
+    self.seqs[i] = 2 * k + 1
+    PLAN_STRUCT.pack_into(self._mm, self.plan_offsets[i], *plan)
+    for j, horizon in enumerate((horizon1, horizon2)):
+      if horizon is None:
+        self.horizons[i, j] = 0
+      else:
+        self.horizons[i, j] = horizon
+    self.seqs[i] = 2 * k + 2
+    self.head = k + 1
+    self.header['head'] = self.head
+
+  def close(self):
+    del self.header, self.seqs, self.horizons
+    self._mm.close()
+
+
+class PlanRingReader:
+  """Maps the ring read only, any number of them cost the planner nothing"""
+  def __init__(self, path):
+    self.path = path
+    self._open()
+
+  def _open(self):
+    path = self.path
+    with open(path, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      self._ino = os.fstat(f.fileno()).st_ino
+    self.header = np.frombuffer(self._mm, HEADER_DTYPE, 1)
+    magic, version, n_slots, slot_size, _ = self.header[0]
+    if magic != MAGIC or version != VERSION or n_slots != N_SLOTS or slot_size != SLOT_DTYPE.itemsize:
+      self._mm.close()
+      raise Exception(f'Unsupported plan ring {path}, version {version}')
+    # Zero-copy, a slot is only consistent while its seq reads the same before and after
+    self.slots = np.frombuffer(self._mm, SLOT_DTYPE, N_SLOTS, HEADER_SIZE)
+    self.seqs = self.slots['seq']
+
+  @property
+  def head(self):
+    return int(self.header['head'][0])
+
+  def replaced(self):
+    """A restarted planner writes a new ring, this one no longer changes"""
+    try:
+      return os.stat(self.path).st_ino != self._ino
+    except FileNotFoundError:
+      return False
+
+  def read(self, tick):
+    """Copy of the slot of tick, None once overwritten or while torn by the writer"""
+    i = tick % N_SLOTS
+    seq = 2 * tick + 2
+    if self.seqs[i] != seq:
+      return None
+    slot = self.slots[i:i + 1].copy()[0]
+    if self.seqs[i] != seq:
+      return None
+    return slot
+
+  def latest(self, retries=3):
+    for _ in range(retries):
+      head = self.head
+      if head == 0:
+        return None
+      slot = self.read(head - 1)
+      if slot is not None:
+        return slot
+    return None
+
+  def follow(self, interval=0.01, reopen_interval=1.):
+    """
+    Yields (tick, slot) as they're written, skipping ticks overwritten before they were read.
+    Follows a restarted planner to its new ring
+    """
+    tick = self.head
+    last_check = time.monotonic()
+    while True:
+      head = self.head
+      if head == tick and time.monotonic() - last_check > reopen_interval:
+        last_check = time.monotonic()
+        if self.replaced():
+          self.close()
+          self._open()
+          tick = 0
+          continue
+      tick = max(tick, head - N_SLOTS + 1)
+      while tick < head:
+        slot = self.read(tick)
+        if slot is not None:
+          yield tick, slot
+        tick += 1
+      time.sleep(interval)
+
+  def close(self):
+    del self.header, self.slots, self.seqs
+    self._mm.close()
+
+
+def main():
+  from selfdrive.controls.lib.longitudinal_planner import PLAN_RING_PATH
+  reader = PlanRingReader(PLAN_RING_PATH)
+  try:
+    for tick, slot in reader.follow():
+      plan = slot['plan']
+      print(f"{tick} {SOURCES[plan['source']]:<6} v {plan['v_target']:.2f} a {plan['a_target']:+.2f} TR {plan['TR']:.2f}"
+            f" lead {plan['has_lead']} fcw {plan['fcw']} update {plan['stage_ns'][3] / 1e3:.0f} us")
+  except KeyboardInterrupt:
+    pass
+  finally:
+    reader.close()
+
+
+if __name__ == '__main__':
+  main()
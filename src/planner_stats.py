@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+from threading import Thread
+
+# 4 buckets per power of two, ~25% resolution up to ~2^31 ns
+N_BUCKETS = 128
+
+
+def _bucket_floor(b):
+  if b < 4:
+    return b
+  return (4 + b % 4) << (b // 4 - 1)
+
+
+class Histogram:
+  """Fixed size histogram of durations in ns, add() is a few integer ops"""
+  __slots__ = ('counts', 'n', 'total', 'max', 'last')
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.counts = [0] * N_BUCKETS
+    self.n = 0
+    self.total = 0
+    self.max = 0
+    self.last = 0
+
+  def add(self, ns):
+    bl = ns.bit_length()
+    b = ns if bl <= 2 else (bl - 2) * 4 + ((ns >> (bl - 3)) & 3)
+    self.counts[b if b < N_BUCKETS else N_BUCKETS - 1] += 1
+    self.n += 1
+    self.total += ns
+    self.last = ns
+    if ns > self.max:
+      self.max = ns
+
+  def percentile(self, q):
+    """Middle of the bucket holding the q-th percentile, in ns"""
+    target = q / 100. * self.n
+    seen = 0
+    for b, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= target:
+        return (_bucket_floor(b) + _bucket_floor(b + 1)) / 2
+    return 0
+
+  def summary(self):
+    if not self.n:
+      return {'n': 0}
+    return {'n': self.n, 'mean_us': self.total / self.n / 1e3, 'p50_us': self.percentile(50) / 1e3,
+            'p99_us': self.percentile(99) / 1e3, 'max_us': self.max / 1e3}
+
+
+class PlannerStats:
+  """
+  Always on planner instrumentation: per stage duration histograms, event counters
+  and gauges (callables read only when a snapshot is taken, for counters kept elsewhere)
+  """
+  def __init__(self):
+    self.histograms = {}
+    self.counters = {}
+    self.gauges = {}
+
+  def histogram(self, name):
+    """Get once and keep, so the hot path skips the dict lookup"""
+    if name not in self.histograms:
+      self.histograms[name] = Histogram()
+    return self.histograms[name]
+
+  def count(self, name, n=1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def gauge(self, name, fn):
+    self.gauges[name] = fn
+
+  def snapshot(self, reset=False):
+    snap = {
+      'timers': {name: h.summary() for name, h in list(self.histograms.items())},
+      'counters': dict(self.counters),
+      'gauges': {name: fn() for name, fn in list(self.gauges.items())},
+    }
+    if reset:
+      for h in list(self.histograms.values()):
+        h.reset()
+    return snap
+
+  def dump(self, path, reset=False):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.snapshot(reset), f, indent=2)
+    os.replace(tmp_path, path)
+
+  def serve(self, path):
+    """Answers every connection to the unix socket at path with a JSON snapshot"""
+    if os.path.exists(path):
+      os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+
+    def serve_loop():
+      while True:
+        try:
+          conn, _ = sock.accept()
+        except OSError:  # stop_serving
+          break
+        with conn:
+          try:
+            conn.sendall(json.dumps(self.snapshot()).encode())
+          except OSError:
+            pass
+
+    Thread(target=serve_loop, daemon=True).start()
+    return sock
+
+  @staticmethod
+  def stop_serving(sock):
+    path = sock.getsockname()
+    sock.shutdown(socket.SHUT_RDWR)  # wakes up accept
+    sock.close()
+    if os.path.exists(path):
+      os.remove(path)
+
+
+stats = PlannerStats()
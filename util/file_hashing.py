@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import shutil
+import time
+
+CHUNK_SIZE = 1 << 20
+HASH_WORKERS = 4  # hashlib releases the GIL on large updates
+
+
+@dataclass
+class FileDigest:
+    path: str
+    md5: str  # None if the file doesn't exist
+    seconds: float
+    cached: bool
+
+
+def stat_key(st):
+    """Changes whenever the file is rewritten or replaced"""
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+
+class DigestCache:
+    """
+    Digests by path, valid while (size, mtime, inode) match.
+    Replacing a file with a rename gives it a new inode, so that invalidates too
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass  # Missing or torn, start over
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == stat_key(st):
+            return entry[3]
+        return None
+
+    def put(self, path, md5, st=None):
+        st = os.stat(path) if st is None else st
+        self.entries[path] = stat_key(st) + [md5]
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+def _digest(path, cache):
+    start = time.monotonic()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return FileDigest(path, None, time.monotonic() - start, False)
+    md5 = cache.get(path, st) if cache is not None else None
+    if md5 is not None:
+        return FileDigest(path, md5, time.monotonic() - start, True)
+    md5 = file_md5(path)
+    if cache is not None:
+        cache.put(path, md5, st)
+    return FileDigest(path, md5, time.monotonic() - start, False)
+
+
+def hash_files(paths, cache=None, workers=HASH_WORKERS):
+    """Returns: {path: FileDigest}, hashed concurrently, cached digests reused"""
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {d.path: d for d in executor.map(lambda p: _digest(p, cache), paths)}
+
+
+def atomic_copy(src, dst, cache=None, md5=None):
+    """
+    Copies into a temp file next to dst and renames it over dst, so dst is never partially written
+    and a running process keeps its mapping of the old file. md5 of src goes into the cache for dst
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = f'{dst}.tmp{os.getpid()}'
+    try:
+        shutil.copyfile(src, tmp_path)
+        shutil.copymode(src, tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if cache is not None and md5 is not None:
+        cache.put(dst, md5)
@@ -0,0 +1,137 @@
+"""
+Index of known upstream digests of the files the patch replaces, per openpilot release,
+and where each release's patched files are.
+
+  {"index_version": 1,
+   "releases": {"0.8.5": {"patch_path": "src"}},
+   "upstream": {"long_mpc.py": {"<md5>": ["0.8.5"]}}}
+
+Rebuild after adding a release, from a directory with the upstream selfdrive/controls/lib
+of each release in <releases_dir>/<release>:
+
+  python util/hash_index.py releases/ --patch-path 0.8.5=src --patch-path 0.8.6=releases/0.8.6/src
+"""
+import argparse
+from collections import Counter
+import json
+import os
+
+from file_hashing import hash_files
+
+INDEX_VERSION = 1
+
+
+def patch_files(patch_dir):
+    """Relative paths of everything the patch installs from patch_dir"""
+    rel_paths = []
+    for parent, dirs, files in os.walk(patch_dir):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for file in sorted(files):
+            if not file.endswith('.pyc'):
+                rel_paths.append(os.path.relpath(f'{parent}/{file}', patch_dir))
+    return rel_paths
+
+
+class HashIndex:
+    """Loaded on first use, a boot verified from the install manifest never reads it"""
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('index_version') != INDEX_VERSION:
+                raise Exception(f'Unsupported hash index version {data.get("index_version")}')
+            self._data = data
+        return self._data
+
+    def releases(self):
+        return list(self.data['releases'])
+
+    def patch_path(self, release):
+        return self.data['releases'][release]['patch_path']
+
+    def replaced_files(self, release=None):
+        """Files the patch replaces, in any release if None"""
+        return [rel_path for rel_path, digests in self.data['upstream'].items()
+                if release is None or any(release in releases for releases in digests.values())]
+
+    def releases_of(self, rel_path, md5):
+        """Releases whose upstream rel_path has this digest"""
+        return self.data['upstream'].get(rel_path, {}).get(md5, [])
+
+    def upstream_md5(self, rel_path, release):
+        """None for files the release doesn't have"""
+        for md5, releases in self.data['upstream'].get(rel_path, {}).items():
+            if release in releases:
+                return md5
+        return None
+
+    def candidate_releases(self, disk_md5s, preferred=None):
+        """
+        Orders releases by how many disk files match their upstream digests, preferred breaks ties.
+        Files matching none may already be patched, so every release stays a candidate
+        """
+        matches = Counter()
+        for rel_path, md5 in disk_md5s.items():
+            matches.update(self.releases_of(rel_path, md5))
+        return sorted(self.releases(), key=lambda release: (-matches[release], release != preferred))
+
+
+def build(releases_dir, patch_paths, index=None):
+    """Adds or replaces the releases in releases_dir, returns the index data"""
+    index = index or {'index_version': INDEX_VERSION, 'releases': {}, 'upstream': {}}
+    patch_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    for release in sorted(os.listdir(releases_dir)):
+        upstream_dir = f'{releases_dir}/{release}'
+        if not os.path.isdir(upstream_dir):
+            continue
+        patch_path = patch_paths.get(release, 'src')
+        for digests in index['upstream'].values():
+            for releases in digests.values():
+                if release in releases:
+                    releases.remove(release)
+
+        replaced = [f for f in patch_files(f'{patch_root}/{patch_path}') if os.path.exists(f'{upstream_dir}/{f}')]
+        upstream = hash_files([f'{upstream_dir}/{f}' for f in replaced])
+        for rel_path in replaced:
+            releases = index['upstream'].setdefault(rel_path, {}).setdefault(upstream[f'{upstream_dir}/{rel_path}'].md5, [])
+            releases.append(release)
+        index['releases'][release] = {'patch_path': patch_path}
+        print(f'{release}: {len(replaced)} replaced files, patch in {patch_path}')
+
+    for rel_path in list(index['upstream']):
+        digests = {md5: releases for md5, releases in index['upstream'][rel_path].items() if releases}
+        if digests:
+            index['upstream'][rel_path] = digests
+        else:
+            del index['upstream'][rel_path]
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('releases_dir', help='upstream selfdrive/controls/lib of each release, in <release> subdirectories')
+    parser.add_argument('--patch-path', action='append', default=[], metavar='RELEASE=PATH',
+                        help='patched files of a release relative to the patch root, src by default')
+    parser.add_argument('--index', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hash_index.json'),
+                        help='index to update')
+    args = parser.parse_args()
+
+    index = None
+    if os.path.exists(args.index):
+        with open(args.index) as f:
+            index = json.load(f)
+    index = build(args.releases_dir, dict(p.split('=', 1) for p in args.patch_path), index)
+    tmp_path = f'{args.index}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, args.index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+from dataclasses import asdict, dataclass, field
+import hashlib
+import json
+import os
+
+from file_hashing import atomic_copy, stat_key
+
+MANIFEST_VERSION = 1
+
+INSTALLING = 'installing'
+INSTALLED = 'installed'
+RESTORING = 'restoring'
+RESTORED = 'restored'
+ROLLED_BACK = 'rolled_back'  # a swap failed or was interrupted and was undone, disk is as before it
+
+STAGED_SUFFIX = '.staged'
+PREV_SUFFIX = '.prev'
+
+
+@dataclass
+class ManifestEntry:
+    rel_path: str
+    orig_md5: str  # None if openpilot doesn't have the file
+    installed_md5: str
+    installed_stat: list = None  # stat_key of the installed disk file
+    target_stat: list = None  # stat_key of the patch file it was copied from
+
+
+@dataclass
+class Manifest:
+    state: str
+    patch_version: str = None
+    entries: dict = field(default_factory=dict)  # rel_path -> ManifestEntry
+    journal: dict = field(default_factory=dict)  # rel_path -> existed before, for the swap in progress
+    release: str = None  # openpilot release the patch was installed for
+    patch_path: str = None  # where its patched files are, relative to the patch root
+    manifest_version: int = MANIFEST_VERSION
+
+
+def patch_version(md5s):
+    """Content version of a file set, from its digests"""
+    return hashlib.md5(''.join(sorted(md5s)).encode()).hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('manifest_version') != MANIFEST_VERSION:
+        return None
+    data['entries'] = {rel_path: ManifestEntry(**entry) for rel_path, entry in data['entries'].items()}
+    return Manifest(**data)
+
+
+def save_manifest(manifest, path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(asdict(manifest), f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def path_stat_key(path):
+    try:
+        return stat_key(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def manifest_verifies(manifest, disk_path, patch_root):
+    """True if nothing was touched since a clean install, from stat alone"""
+    if manifest is None or manifest.state != INSTALLED or manifest.patch_path is None:
+        return False
+    target_path = f'{patch_root}/{manifest.patch_path}'
+    for entry in manifest.entries.values():
+        if (path_stat_key(f'{disk_path}/{entry.rel_path}') != entry.installed_stat or
+                path_stat_key(f'{target_path}/{entry.rel_path}') != entry.target_stat):
+            return False
+    return True
+
+
+class FileSwap:
+    """
+    Stages a set of file replacements and removals next to their destinations, then swaps them
+    all in with renames. Replaced files stay hard linked as .prev until finish(), so a failure
+    midway, or a crash recorded in the manifest journal, is rolled back with rollback()
+    """
+    def __init__(self, root, log):
+        self.root = root
+        self.log = log
+        self.journal = {}  # rel_path -> existed before
+        self.replacements = {}  # rel_path -> source, None to remove
+        self.manifest = None
+        self.manifest_path = None
+
+    def _path(self, rel_path):
+        return f'{self.root}/{rel_path}'
+
+    def stage(self, rel_path, src):
+        self.replacements[rel_path] = src
+        try:
+            atomic_copy(src, self._path(rel_path) + STAGED_SUFFIX)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        """Drops everything staged, before begin()"""
+        for rel_path in self.replacements:
+            if os.path.exists(self._path(rel_path) + STAGED_SUFFIX):
+                os.remove(self._path(rel_path) + STAGED_SUFFIX)
+        self.replacements = {}
+
+    def stage_removal(self, rel_path):
+        self.replacements[rel_path] = None
+
+    def begin(self, manifest, manifest_path, state):
+        """Records the swap in the manifest, so a crash during it rolls back on the next run"""
+        self.journal = {rel_path: os.path.exists(self._path(rel_path)) for rel_path in self.replacements}
+        self.manifest = manifest
+        self.manifest_path = manifest_path
+        manifest.state = state
+        manifest.journal = self.journal
+        save_manifest(manifest, manifest_path)
+
+    def swap(self):
+        try:
+            for rel_path, src in self.replacements.items():
+                path = self._path(rel_path)
+                if self.journal[rel_path]:
+                    if os.path.exists(path + PREV_SUFFIX):
+                        os.remove(path + PREV_SUFFIX)
+                    os.link(path, path + PREV_SUFFIX)
+                if src is None:
+                    if self.journal[rel_path]:
+                        os.remove(path)
+                else:
+                    os.replace(path + STAGED_SUFFIX, path)
+                self.log(f'{rel_path} {"removed" if src is None else "swapped in"}')
+        except BaseException:
+            self.log('Swap failed, rolling back')
+            self.rollback()
+            self.manifest.state = ROLLED_BACK
+            self.manifest.journal = {}
+            save_manifest(self.manifest, self.manifest_path)
+            raise
+
+    def commit(self, manifest):
+        """Records the finished swap in the manifest, then drops what was kept for rolling it back"""
+        manifest.journal = self.journal
+        save_manifest(manifest, self.manifest_path)
+        self.finish()
+        manifest.journal = {}
+        save_manifest(manifest, self.manifest_path)
+
+    def rollback(self, journal=None):
+        for rel_path, existed in (self.journal if journal is None else journal).items():
+            path = self._path(rel_path)
+            prev_path = path + PREV_SUFFIX
+            if os.path.exists(prev_path):
+                if os.path.exists(path) and os.path.samefile(prev_path, path):
+                    os.remove(prev_path)  # Not swapped yet, renaming between links of one file does nothing
+                else:
+                    os.replace(prev_path, path)
+            elif not existed and os.path.exists(path):
+                os.remove(path)
+            # Otherwise the swap didn't get to this file
+            if os.path.exists(path + STAGED_SUFFIX):
+                os.remove(path + STAGED_SUFFIX)
+            self.log(f'{rel_path} rolled back')
+
+    def finish(self, journal=None):
+        """Drops the .prev links and leftover staged files, once the manifest no longer needs them"""
+        for rel_path in (self.journal if journal is None else journal):
+            for suffix in (PREV_SUFFIX, STAGED_SUFFIX):
+                if os.path.exists(self._path(rel_path) + suffix):
+                    os.remove(self._path(rel_path) + suffix)
+
+
+def recover(manifest, manifest_path, disk_path, log):
+    """Rolls back a swap a crash interrupted and cleans up after a finished one"""
+    if manifest is None:
+        return None
+    swap = FileSwap(disk_path, log)
+    if manifest.state in (INSTALLING, RESTORING):
+        log(f'Found an interrupted swap ({manifest.state}), rolling back')
+        swap.rollback(manifest.journal)
+        manifest.state = ROLLED_BACK
+    elif manifest.journal:
+        swap.finish(manifest.journal)
+    else:
+        return manifest
+    manifest.journal = {}
+    save_manifest(manifest, manifest_path)
+    return manifest
+
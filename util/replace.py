@@ -1,10 +1,14 @@
-from dataclasses import dataclass
+import argparse
 from datetime import datetime
-import hashlib
-import os
-import shutil
 import subprocess
+import sys
 from sys import stdout
+import time
+
+from file_hashing import DigestCache, atomic_copy, hash_files
+from hash_index import HashIndex, patch_files
+from install_manifest import INSTALLED, INSTALLING, FileSwap, Manifest, ManifestEntry, load_manifest, manifest_verifies, \
+                             patch_version, path_stat_key, recover
 
 def log(message):
     print(f"{datetime.now()} {message}")
@@ -12,67 +16,98 @@ def log(message):
 
 log('Start')
 disk_path = '/data/openpilot/selfdrive/controls/lib'
-backup_path = '/data/openpilot-patch/backup'
-target_path = '/data/openpilot-patch/src'
-
-@dataclass
-class HashedFile:
-    rel_path: str
-    orig_md5: str
-
-hashed_files = [
-    HashedFile('long_mpc.py', 'cd3cc9503927eff6b350f47dec90dc39'),
-    HashedFile('longitudinal_planner.py', 'b4cf0480a5c54c7c7c3f58af7e361b0f'),
-    HashedFile('longitudinal_mpc/longitudinal_mpc.c', '3e509bd185e5fee736b7aed568536c33'),
-    HashedFile('longitudinal_mpc/lib_mpc_export/acado_solver.c', '6e731dad215753195cc960a555d7320a'),
-    HashedFile('longitudinal_mpc/libmpc_py.py', '40563a2710e5824c3ede434f05b2d924'),
-    HashedFile('longitudinal_mpc/libmpc1.so', 'fbf3a9c58f3ce9d14fb7818550577003'),
-    HashedFile('longitudinal_mpc/libmpc2.so', 'fbf3a9c58f3ce9d14fb7818550577003')
-]
-
-new_files = [
-    'dynamic_follow/__init__.py',
-    'dynamic_follow/support.py'
-]
-
-def file_md5(path):
-    with open(path, 'rb') as f:
-        contents = f.read()
-        return hashlib.md5(contents).hexdigest()
-
-os.makedirs(backup_path, exist_ok=True)
-
-files_to_backup = []
-files_to_copy = new_files
-for hashed_file in hashed_files:
-    disk_md5 = file_md5(f'{disk_path}/{hashed_file.rel_path}')
-    target_md5 = file_md5(f'{target_path}/{hashed_file.rel_path}')
-    if disk_md5 == hashed_file.orig_md5:
-        log(f'{hashed_file.rel_path} needs to be replaced')
-        files_to_backup.append(hashed_file.rel_path)
-        files_to_copy.append(hashed_file.rel_path)
-    elif disk_md5 == target_md5:
-        log(f'{hashed_file.rel_path} is same as target')
-    else:
-        log(f'{hashed_file.rel_path} has unknown hash: {disk_md5}')
-        subprocess.Popen(['python', '/data/openpilot-patch/util/error.py'])
-        raise Exception('Unknown hash')
+patch_root = '/data/openpilot-patch'
+backup_path = f'{patch_root}/backup'
+cache_path = f'{patch_root}/hash_cache.json'
+manifest_path = f'{patch_root}/manifest.json'
+index_path = f'{patch_root}/util/hash_index.json'
+
+parser = argparse.ArgumentParser(description='Installs the patch into openpilot')
+parser.add_argument('--dry-run', action='store_true', help='only report what would be backed up and copied, with hash timing')
+args = parser.parse_args()
+
+start = time.monotonic()
+cache = DigestCache(cache_path)
+
+if args.dry_run:
+    manifest = load_manifest(manifest_path)
+    if manifest is not None and manifest.journal:
+        log(f'Manifest has an unfinished swap ({manifest.state})')
+else:
+    manifest = recover(load_manifest(manifest_path), manifest_path, disk_path, log)
+if manifest_verifies(manifest, disk_path, patch_root):
+    log(f'Patch {manifest.patch_version} for {manifest.release} is installed and unchanged')
+    log(f'Finish in {time.monotonic() - start:.3f} s')
+    sys.exit(0)
+
+def disk_file(rel_path):
+    return f'{disk_path}/{rel_path}'
+
+# Which release is on disk, from the upstream digests of the files the patch replaces
+index = HashIndex(index_path)
+replaced_any = index.replaced_files()
+disk_digests = hash_files([disk_file(f) for f in replaced_any], cache)
+disk_md5s = {f: disk_digests[disk_file(f)].md5 for f in replaced_any}
+
+for release in index.candidate_releases(disk_md5s, manifest.release if manifest is not None else None):
+    target_path = f'{patch_root}/{index.patch_path(release)}'
+    replaced = index.replaced_files(release)
+    all_files = replaced + [f for f in patch_files(target_path) if f not in replaced]
+    digests = hash_files([disk_file(f) for f in all_files] + [f'{target_path}/{f}' for f in all_files], cache)
+
+    def disk_md5(rel_path):
+        return digests[disk_file(rel_path)].md5
+
+    def target_md5(rel_path):
+        return digests[f'{target_path}/{rel_path}'].md5
+
+    files_to_backup = [f for f in replaced if release in index.releases_of(f, disk_md5(f))]
+    unknown = [f for f in replaced if f not in files_to_backup and disk_md5(f) != target_md5(f)]
+    if not unknown:
+        break
+    log(f'Not {release}, unknown hashes: ' + ', '.join(f'{f} {disk_md5(f)}' for f in unknown))
+else:
+    if not args.dry_run:
+        subprocess.Popen(['python', f'{patch_root}/util/error.py'])
+    raise Exception('Unknown hash')
+
+log(f'Installing the patch for {release} from {target_path}')
+if args.dry_run:
+    for digest in digests.values():
+        log(f'{digest.path}: {digest.md5} in {digest.seconds * 1e3:.1f} ms{" (cached)" if digest.cached else ""}')
+log(f'Hashed in {time.monotonic() - start:.3f} s')
 
 for file_to_backup in files_to_backup:
-    backup_full_path = f'{backup_path}/{file_to_backup}'
-    if os.path.exists(backup_full_path):
-        os.remove(backup_full_path)
-    os.makedirs(os.path.dirname(backup_full_path), exist_ok=True)
-        
-    shutil.copy(f'{disk_path}/{file_to_backup}', backup_full_path)
+    if args.dry_run:
+        log(f'{file_to_backup} would be backed up')
+        continue
+    atomic_copy(disk_file(file_to_backup), f'{backup_path}/{file_to_backup}')
     log(f'{file_to_backup} backed up')
 
-for file_to_copy in files_to_copy:
-    copy_full_path = f'{disk_path}/{file_to_copy}'
-    if os.path.exists(copy_full_path):
-        os.remove(copy_full_path)
-    os.makedirs(os.path.dirname(copy_full_path), exist_ok=True)
-    shutil.copy(f'{target_path}/{file_to_copy}', copy_full_path)
-    log(f'{file_to_copy} copied')
+swap = FileSwap(disk_path, log)
+for file_to_copy in all_files:
+    if disk_md5(file_to_copy) == target_md5(file_to_copy):
+        log(f'{file_to_copy} is same as target')
+    elif args.dry_run:
+        log(f'{file_to_copy} would be copied')
+    else:
+        swap.stage(file_to_copy, f'{target_path}/{file_to_copy}')
+        log(f'{file_to_copy} staged')
+
+if args.dry_run:
+    log(f'Finish in {time.monotonic() - start:.3f} s')
+    sys.exit(0)
+
+# All or nothing from here, a crash midway is rolled back on the next run
+swap.begin(manifest or Manifest(INSTALLING), manifest_path, INSTALLING)
+swap.swap()
+for file_to_copy in swap.replacements:
+    cache.put(disk_file(file_to_copy), target_md5(file_to_copy))
 
-log('Finish')
+entries = {f: ManifestEntry(f, index.upstream_md5(f, release), target_md5(f), path_stat_key(disk_file(f)),
+                           path_stat_key(f'{target_path}/{f}'))
+           for f in all_files}
+swap.commit(Manifest(INSTALLED, patch_version(target_md5(f) for f in all_files), entries,
+                     release=release, patch_path=index.patch_path(release)))
+cache.save()
+log(f'Finish in {time.monotonic() - start:.3f} s')